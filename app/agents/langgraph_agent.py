@@ -1,13 +1,15 @@
+import asyncio
 import json
+import uuid
 
 from pydantic import BaseModel, Field
 
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import create_react_agent
 
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
 
-from app.tools.kb_tools import build_kb_tools
+from app.tools.kb_tools import build_kb_tools, _format_hits, _split_queries
 from app.tools.db_tools import build_db_tools
 from app.tools.web_tools import build_web_tools
 
@@ -26,12 +28,32 @@ KB_SYSTEM = """Ты KB-агент (RAG). Используй ТОЛЬКО инс
 
 Правила:
 - Сначала вызови kb_search по вопросу.
+- Если нужно проверить несколько формулировок, передай их в один вызов kb_search через " || ".
 - В ответе делай цитирование из найденных данных.
 - Если hits пустые — прямо скажи "В KB нет данных" (без источников).
 - НЕ пиши в ответе номера чанков, chunk_id, пути к файлам.
 - В блоке "Источники" (если пишешь) указывай только уникальные ИМЕНА ФАЙЛОВ (например: runbook.md), без повторов, без путей.
 """
 
+KB_PREFETCH_NOTE = """
+- kb_search по вопросу пользователя уже выполнен, результат есть в истории. Повторно вызывай kb_search только с другими формулировками, если найденного недостаточно.
+"""
+
+KB_MORE_MARKER = "NEED_SEARCH"
+
+KB_DIRECT_SYSTEM = """Ты KB-агент (RAG). Отвечай ТОЛЬКО по фрагментам из базы знаний ниже.
+
+Правила:
+- В ответе делай цитирование из найденных данных.
+- Если фрагментов нет — прямо скажи "В KB нет данных" (без источников).
+- Если фрагменты не отвечают на вопрос и нужен поиск с другими формулировками, ответь ОДНОЙ строкой: NEED_SEARCH: <формулировки через " || ">.
+- НЕ пиши в ответе номера фрагментов, chunk_id, пути к файлам.
+- В блоке "Источники" (если пишешь) указывай только уникальные ИМЕНА ФАЙЛОВ (например: runbook.md), без повторов, без путей.
+
+Фрагменты:
+{context}
+"""
+
 DB_SYSTEM = """Ты DB-агент. Используй ТОЛЬКО SQL инструменты (sql_db_*).
 
 Правила:
@@ -50,6 +72,9 @@ WEB_SYSTEM = """Ты WEB-агент. Используй ТОЛЬКО web_search.
 class AgentState(BaseModel):
     messages: list = Field(default_factory=list)
     route: str = ""
+    route_by: str = ""
+    kb_prefetch: dict | None = None
+    kb_k: int = 5
     kb_sources: list = Field(default_factory=list)
 
 # HELPERS 
@@ -102,7 +127,9 @@ def _extract_kb_sources_from_messages(messages):
         except Exception:
             data = None
         if isinstance(data, dict):
-            hits = data.get("hits") or []
+            hits = list(data.get("hits") or [])
+            for r in data.get("results") or []:
+                hits.extend(r.get("hits") or [])
             for h in hits:
                 s = (h.get("source") or "").strip()
                 if not s:
@@ -115,37 +142,142 @@ def _extract_kb_sources_from_messages(messages):
         break
     return srcs
 
+def _hits_context(hits):
+    parts = []
+    for i, h in enumerate(hits, 1):
+        ref = h["source"]
+        if "page" in h:
+            ref += f", стр. {h['page']}"
+        parts.append(f"[{i}] {ref}\n{h['text']}")
+    return "\n\n".join(parts) or "(пусто)"
+
+def _hits_sources(hits):
+    return list(dict.fromkeys(h["source"] for h in hits if h.get("source")))
+
 # GRAPH
 
-def build_langgraph(planner_llm, kb_agent_llm, db_agent_llm, web_agent_llm, rag, postgres_url):
-    kb_tools = build_kb_tools(rag)
+def _prefetch_messages(question, result):
+    call_id = f"call_prefetch_{uuid.uuid4().hex[:12]}"
+    return [AIMessage(content="", tool_calls=[{"name": "kb_search", "args": {"__arg1": question}, "id": call_id}]),
+        ToolMessage(content=json.dumps(result, ensure_ascii=False), tool_call_id=call_id, name="kb_search")]
+
+def build_langgraph(planner_llm, kb_agent_llm, db_agent_llm, web_agent_llm, rag, postgres_url, retrieval_pool=None,
+        collections=None, router=None, speculative=False, direct=False):
+    kb_tools = build_kb_tools(rag, retrieval_pool, collections)
     db_tools = build_db_tools(db_agent_llm, postgres_url)
     web_tools = build_web_tools()
 
     kb_executor = create_react_agent(model=kb_agent_llm, tools=kb_tools)
     db_executor = create_react_agent(model=db_agent_llm, tools=db_tools)
     web_executor = create_react_agent(model=web_agent_llm, tools=web_tools)
+    planner_llm = planner_llm.with_config(tags=["planner"])
+    kb_direct_llm = kb_agent_llm.with_config(tags=["kb_direct"])
+
+    audits = set()
+
+    async def _retrieve(fn):
+        try:
+            if retrieval_pool is None:
+                return await asyncio.to_thread(fn)
+            return await retrieval_pool.run(fn)
+        except Exception:
+            return None
+
+    async def _prefetch(q, k=5):
+        return await _retrieve(lambda: {"hits": _format_hits(rag.search(q, k=k))})
+
+    async def _search_more(queries, k=5):
+        return await _retrieve(lambda: {"results": [{"query": q, "hits": _format_hits(h)}
+            for q, h in zip(queries, rag.search_batch(queries, k=k))]})
+
+    async def _with_prefetch(task, out):
+        if task is None or out["route"] != "kb":
+            if task is not None:
+                task.cancel()
+            return {**out, "kb_prefetch": None}
+        try:
+            result = await task
+        except Exception:
+            result = None
+        return {**out, "kb_prefetch": result}
+
+    async def _llm_route(q):
+        try:
+            out = await planner_llm.ainvoke([SystemMessage(content=PLANNER_SYSTEM),
+                HumanMessage(content=q)])
+        except Exception:
+            return None
+        txt = (out.content or "").strip().upper()
+        if "DB" in txt:
+            return "db"
+        if "WEB" in txt:
+            return "web"
+        return "kb"
+
+    async def _audit(q, guess):
+        route = await _llm_route(q)
+        if route is not None:
+            router.learn(q, route, guess, audit=True)
+
     async def planner_node(state):
         q = _last_user_text(_sget(state, "messages", []))
         route = _fast_heuristic_route(q)
-        if route == "kb":
+        if route != "kb":
+            return {"route": route, "route_by": "heuristic", "kb_prefetch": None}
+        prefetch = asyncio.create_task(_prefetch(q, int(_sget(state, "kb_k", 5) or 5))) if speculative and q else None
+        return await _with_prefetch(prefetch, await _plan_kb(q, route))
+
+    async def _plan_kb(q, route):
+        guess = None
+        if router is not None:
             try:
-                out = await planner_llm.ainvoke([SystemMessage(content=PLANNER_SYSTEM),
-                    HumanMessage(content=q)])
-                txt = (out.content or "").strip().upper()
-                if "DB" in txt:
-                    route = "db"
-                elif "WEB" in txt:
-                    route = "web"
-                else:
-                    route = "kb"
+                guess = await asyncio.to_thread(router.predict, q)
             except Exception:
-                pass
-        return {"route": route}
+                guess = None
+        if router is not None and router.is_confident(guess):
+            if router.routed_locally():
+                task = asyncio.create_task(_audit(q, guess))
+                audits.add(task)
+                task.add_done_callback(audits.discard)
+            return {"route": guess[0], "route_by": "router"}
+
+        llm_route = await _llm_route(q)
+        if llm_route is None:
+            return {"route": route, "route_by": "heuristic"}
+        if router is not None:
+            router.learn(q, llm_route, guess)
+        return {"route": llm_route, "route_by": "llm"}
+
+    async def _kb_direct(msgs, result):
+        hits = result.get("hits") or []
+        out = await kb_direct_llm.ainvoke([SystemMessage(content=KB_DIRECT_SYSTEM.format(
+            context=_hits_context(hits)))] + msgs)
+        text = (out.content or "").lstrip()
+        if text.startswith(KB_MORE_MARKER):
+            return None, _split_queries(text[len(KB_MORE_MARKER):].split("\n", 1)[0].lstrip(" :"))
+        return {"messages": msgs + [out], "kb_sources": _hits_sources(hits)}, []
 
     async def kb_node(state):
         msgs = list(_sget(state, "messages", []) or [])
-        msgs2 = [SystemMessage(content=KB_SYSTEM)] + msgs
+        q = _last_user_text(msgs)
+        k = int(_sget(state, "kb_k", 5) or 5)
+        prefetched = _sget(state, "kb_prefetch")
+        more = []
+        if direct:
+            if prefetched is None:
+                prefetched = await _prefetch(q, k)
+            if prefetched is not None:
+                out, queries = await _kb_direct(msgs, prefetched)
+                if out is not None:
+                    return out
+                found = await _search_more(queries, k) if queries else None
+                if found is not None:
+                    more = _prefetch_messages(" || ".join(queries), found)
+        if prefetched is not None:
+            msgs2 = [SystemMessage(content=KB_SYSTEM + KB_PREFETCH_NOTE)] + msgs \
+                + _prefetch_messages(q, prefetched) + more
+        else:
+            msgs2 = [SystemMessage(content=KB_SYSTEM)] + msgs
         res = await kb_executor.ainvoke({"messages": msgs2})
         out_msgs = res.get("messages") or msgs2
         srcs = _extract_kb_sources_from_messages(out_msgs)
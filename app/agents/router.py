@@ -0,0 +1,161 @@
+import json
+import os
+import random
+import threading
+from pathlib import Path
+
+import numpy as np
+
+ROUTES = ("kb", "db", "web")
+
+SEED_EXAMPLES = [
+    ("Как перезапустить сервис после ошибки OOM?", "kb"),
+    ("Что делать, если nginx отдаёт 502 Bad Gateway после деплоя?", "kb"),
+    ("Какой порядок действий при откате релиза?", "kb"),
+    ("Где описана настройка бэкапов?", "kb"),
+    ("Как подключиться к VPN по инструкции?", "kb"),
+    ("Что означает ошибка connection refused в runbook?", "kb"),
+    ("How do I rotate the API keys according to the runbook?", "kb"),
+    ("What is the release checklist?", "kb"),
+    ("Сколько заказов было оформлено за прошлый месяц?", "db"),
+    ("Покажи топ-10 клиентов по выручке", "db"),
+    ("Какие колонки есть в таблице users?", "db"),
+    ("Обнови статус заказа 42 на shipped", "db"),
+    ("Посчитай средний чек по регионам", "db"),
+    ("How many active users signed up this week?", "db"),
+    ("List the orders with status pending", "db"),
+    ("Какая сейчас последняя версия Python?", "web"),
+    ("Что нового вышло в Kubernetes в этом году?", "web"),
+    ("Какой курс доллара на сегодня?", "web"),
+    ("Найди свежие новости про уязвимость в OpenSSL", "web"),
+    ("What is the weather in Moscow right now?", "web"),
+    ("Latest release notes of PostgreSQL 17", "web"),
+]
+
+class EmbeddingRouter:
+    def __init__(self, embed, embed_batch=None, min_confidence=0.8, audit_rate=0.05,
+            examples_path: Path | None = None, log_path: Path | None = None, max_log=5000, temperature=0.05):
+        self.embed = embed
+        self.embed_batch = embed_batch or embed
+        self.min_confidence = min_confidence
+        self.audit_rate = audit_rate
+        self.examples_path = examples_path
+        self.log_path = log_path
+        self.max_log = max_log
+        self.temperature = temperature
+        self._sums = None
+        self._counts = np.zeros(len(ROUTES))
+        self._fit_started = False
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._log_lines = None
+        self.stats = {"local": 0, "llm": 0, "agree": 0, "disagree": 0, "audits": 0, "audit_agree": 0}
+
+    def _read_examples(self, path):
+        if path is None or not path.exists():
+            return []
+        out = []
+        for line in path.read_text(encoding="utf-8").splitlines():
+            try:
+                ex = json.loads(line)
+            except ValueError:
+                continue
+            if ex.get("route") in ROUTES and (ex.get("text") or "").strip():
+                out.append((ex["text"], ex["route"]))
+        return out
+
+    def fit(self):
+        examples = SEED_EXAMPLES + self._read_examples(self.examples_path)
+        if self.log_path is not None:
+            examples += self._read_examples(self._rotated_path()) + self._read_examples(self.log_path)
+        emb = np.asarray(self.embed_batch([t for t, _ in examples]), dtype=np.float32)
+        labels = np.array([ROUTES.index(r) for _, r in examples])
+        sums = np.zeros((len(ROUTES), emb.shape[1]), dtype=np.float32)
+        np.add.at(sums, labels, emb)
+        with self._lock:
+            self._sums = sums
+            self._counts = np.bincount(labels, minlength=len(ROUTES)).astype(np.float64)
+        return len(examples)
+
+    def fit_async(self):
+        with self._lock:
+            if self._fit_started:
+                return
+            self._fit_started = True
+        threading.Thread(target=self._fit_background, name="router-fit", daemon=True).start()
+
+    def _fit_background(self):
+        try:
+            self.fit()
+        except Exception:
+            with self._lock:
+                self._fit_started = False
+
+    def predict(self, text):
+        if self._sums is None:
+            self.fit_async()
+            return None
+        q = np.asarray(self.embed([text]), dtype=np.float32)[0]
+        with self._lock:
+            cent = self._sums / np.maximum(np.linalg.norm(self._sums, axis=1, keepdims=True), 1e-12)
+        sims = cent @ q
+        p = np.exp((sims - sims.max()) / self.temperature)
+        p /= p.sum()
+        i = int(np.argmax(p))
+        return ROUTES[i], float(p[i]), q
+
+    def is_confident(self, guess):
+        return guess is not None and guess[1] >= self.min_confidence
+
+    def routed_locally(self):
+        with self._lock:
+            self.stats["local"] += 1
+        return self.audit_rate > 0 and random.random() < self.audit_rate
+
+    def learn(self, text, route, guess=None, audit=False):
+        if route not in ROUTES:
+            return
+        with self._lock:
+            if audit:
+                self.stats["audits"] += 1
+                self.stats["audit_agree"] += int(guess is not None and guess[0] == route)
+            else:
+                self.stats["llm"] += 1
+                if guess is not None:
+                    self.stats["agree" if guess[0] == route else "disagree"] += 1
+            if guess is not None and self._sums is not None:
+                i = ROUTES.index(route)
+                self._sums[i] += guess[2]
+                self._counts[i] += 1
+        if self.log_path is not None:
+            self._log(json.dumps({"text": text, "route": route}, ensure_ascii=False))
+
+    def _rotated_path(self):
+        return self.log_path.with_name(self.log_path.name + ".1")
+
+    def _log(self, line):
+        # two halves of max_log lines each: the log and its .1 predecessor, so at most max_log lines are kept
+        half = max(1, self.max_log // 2)
+        with self._log_lock:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            if self._log_lines is None:
+                self._log_lines = len(self.log_path.read_bytes().splitlines()) if self.log_path.exists() else 0
+            if self._log_lines >= half:
+                os.replace(self.log_path, self._rotated_path())
+                self._log_lines = 0
+            with self.log_path.open("a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self._log_lines += 1
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+            out["ready"] = self._sums is not None
+            out["examples"] = {r: int(c) for r, c in zip(ROUTES, self._counts)}
+        compared = out["agree"] + out["disagree"]
+        out["agreement"] = out["agree"] / compared if compared else None
+        out["audit_agreement"] = out["audit_agree"] / out["audits"] if out["audits"] else None
+        total = out["local"] + out["llm"]
+        out["local_rate"] = out["local"] / total if total else None
+        out["min_confidence"] = self.min_confidence
+        return out
@@ -24,19 +24,71 @@ class Settings:
     chat_ttl_seconds = int(os.getenv("CHAT_TTL_SECONDS"))
     chat_max_turns = int(os.getenv("CHAT_MAX_TURNS"))
 
+    router_enabled = os.getenv("ROUTER_ENABLED", "1") == "1"
+    router_min_confidence = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.8"))
+    router_audit_rate = float(os.getenv("ROUTER_AUDIT_RATE", "0.05"))
+    router_examples_path = Path(os.getenv("ROUTER_EXAMPLES_PATH")) if os.getenv("ROUTER_EXAMPLES_PATH") else None
+    router_log = os.getenv("ROUTER_LOG", "0") == "1"
+    router_log_path = Path(os.getenv("ROUTER_LOG_PATH", str(BASE_DIR / ".kb_index" / "router_routes.jsonl")))
+    router_log_max_lines = int(os.getenv("ROUTER_LOG_MAX_LINES", "5000"))
+
     postgres_url = os.getenv("POSTGRES_URL")
 
     kb_dir = Path(str(BASE_DIR / "kb"))
     kb_index_dir = Path(str(BASE_DIR / ".kb_index"))
+    kb_collections_dir = Path(os.getenv("KB_COLLECTIONS_DIR", str(BASE_DIR / "kb_collections")))
+    kb_collections_memory_mb = int(os.getenv("KB_COLLECTIONS_MEMORY_MB", "2048"))
+    kb_collections_max_loaded = int(os.getenv("KB_COLLECTIONS_MAX_LOADED", "16"))
     kb_emb_model = os.getenv("KB_EMB_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+    kb_emb_cache = os.getenv("KB_EMB_CACHE", "1") == "1"
+    kb_emb_cache_dtype = os.getenv("KB_EMB_CACHE_DTYPE", "float16")
     kb_chunk_max_chars = int(os.getenv("KB_CHUNK_MAX_CHARS"))
     kb_chunk_overlap_chars = int(os.getenv("KB_CHUNK_OVERLAP_CHARS"))
+    kb_ingest_workers = int(os.getenv("KB_INGEST_WORKERS", "0"))
+    kb_embed_batch_size = int(os.getenv("KB_EMBED_BATCH_SIZE", "256"))
     kb_hybrid_alpha = float(os.getenv("KB_HYBRID_ALPHA"))
     kb_candidates = int(os.getenv("KB_CANDIDATES"))
+    kb_fusion = os.getenv("KB_FUSION", "minmax")
+    kb_rrf_k = int(os.getenv("KB_RRF_K", "60"))
+    kb_query_cache = os.getenv("KB_QUERY_CACHE", "1") == "1"
+    kb_query_emb_cache_size = int(os.getenv("KB_QUERY_EMB_CACHE_SIZE", "4096"))
+    kb_result_cache_size = int(os.getenv("KB_RESULT_CACHE_SIZE", "1024"))
+    kb_query_cache_redis = os.getenv("KB_QUERY_CACHE_REDIS", "0") == "1"
+    kb_query_cache_ttl_seconds = int(os.getenv("KB_QUERY_CACHE_TTL_SECONDS", "3600"))
     kb_max_upload_bytes = int(os.getenv("KB_MAX_UPLOAD_BYTES"))
     kb_use_rerank = os.getenv("KB_USE_RERANK") == "1"
     kb_rerank_model = os.getenv("KB_RERANK_MODEL")
     kb_rerank_topn = int(os.getenv("KB_RERANK_TOPN"))
+    kb_rerank_batch_size = int(os.getenv("KB_RERANK_BATCH_SIZE", "32"))
+    kb_rerank_budget_ms = int(os.getenv("KB_RERANK_BUDGET_MS", "0"))
+    kb_rerank_skip_margin = float(os.getenv("KB_RERANK_SKIP_MARGIN", "0"))
+    kb_rerank_cache_size = int(os.getenv("KB_RERANK_CACHE_SIZE", "20000"))
+
+    kb_retrieval_workers = int(os.getenv("KB_RETRIEVAL_WORKERS", "4"))
+    kb_retrieval_queue = int(os.getenv("KB_RETRIEVAL_QUEUE", "64"))
+    kb_retrieval_timeout_seconds = float(os.getenv("KB_RETRIEVAL_TIMEOUT_SECONDS", "30"))
+    kb_query_batch_window_ms = float(os.getenv("KB_QUERY_BATCH_WINDOW_MS", "3"))
+    kb_query_batch_max = int(os.getenv("KB_QUERY_BATCH_MAX", "64"))
+    kb_model_backend = os.getenv("KB_MODEL_BACKEND", "torch")
+    kb_onnx_quant_config = os.getenv("KB_ONNX_QUANT_CONFIG", "avx2")
+    kb_onnx_min_parity = float(os.getenv("KB_ONNX_MIN_PARITY", "0.98"))
+
+    kb_ann_index = os.getenv("KB_ANN_INDEX", "auto")
+    kb_ann_hnsw_min_chunks = int(os.getenv("KB_ANN_HNSW_MIN_CHUNKS", "50000"))
+    kb_ann_ivf_min_chunks = int(os.getenv("KB_ANN_IVF_MIN_CHUNKS", "1000000"))
+    kb_ann_hnsw_m = int(os.getenv("KB_ANN_HNSW_M", "32"))
+    kb_ann_ef_construction = int(os.getenv("KB_ANN_EF_CONSTRUCTION", "200"))
+    kb_ann_ef_search = int(os.getenv("KB_ANN_EF_SEARCH", "64"))
+    kb_ann_nprobe = int(os.getenv("KB_ANN_NPROBE", "16"))
+    kb_ann_pq_m = int(os.getenv("KB_ANN_PQ_M", "0"))
+    kb_ann_min_recall = float(os.getenv("KB_ANN_MIN_RECALL", "0.9"))
+    kb_faiss_mmap = os.getenv("KB_FAISS_MMAP", "1") == "1"
+    kb_vector_storage = os.getenv("KB_VECTOR_STORAGE", "float32")
+    kb_vector_rescore = int(os.getenv("KB_VECTOR_RESCORE", "4"))
+    kb_index_watch_seconds = float(os.getenv("KB_INDEX_WATCH_SECONDS", "2"))
+    kb_warmup = os.getenv("KB_WARMUP", "1") == "1"
+    kb_speculative = os.getenv("KB_SPECULATIVE", "1") == "1"
+    kb_direct = os.getenv("KB_DIRECT", "1") == "1"
 
 
 settings = Settings()
@@ -1,8 +1,13 @@
+import asyncio
+import json
 import re
+import threading
+import time
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from redis import Redis
 
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
@@ -10,13 +15,22 @@ from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 from app.config import settings
 from app.schemas import (AskRequest, AskResponse,
     SessionInfo, CreateSessionResponse,
-    ReindexResponse, UploadResponse)
+    ReindexResponse, ReindexJobResponse, UploadResponse,
+    KBSearchBatchRequest, KBSearchBatchResponse)
 from app.rag.rag import HybridRAG
+from app.rag.ann import AnnParams
+from app.rag.backends import ModelCache
+from app.rag.collection import CollectionManager, UnknownCollection, DEFAULT_COLLECTION
+from app.rag.filters import SearchFilter
+from app.rag.cache import QueryCache
+from app.rag.jobs import ReindexJobs
+from app.rag.pool import RetrievalPool, RetrievalBusy
 from app.memory.redis_history import get_history
 from app.memory.sessions import create_session, list_sessions, get_title, set_title
 from app.memory.sessions import delete_session
-from app.agents.langgraph_agent import build_langgraph
+from app.agents.langgraph_agent import build_langgraph, KB_MORE_MARKER
 from app.agents.llm import build_llm_openrouter
+from app.agents.router import EmbeddingRouter
 
 app = FastAPI(title="Agent System")
 
@@ -27,6 +41,7 @@ app.add_middleware(CORSMiddleware,
     allow_headers=["*"])
 
 redis_client = Redis.from_url(settings.redis_url, decode_responses=False)
+model_cache = ModelCache()
 
 def _safe_filename(name):
     name = (name or "").strip().replace("\\", "/").split("/")[-1]
@@ -39,23 +54,108 @@ def _auto_title(question, max_len=60):
         return q
     return q[: max_len - 1] + "…"
 
-def _build_rag():
-    return HybridRAG(kb_dir=settings.kb_dir,
-        index_dir=settings.kb_index_dir,
+def _build_query_cache():
+    if not settings.kb_query_cache:
+        return None
+    # shared by all collections: results are keyed by build_id, embeddings by model
+    return QueryCache(emb_size=settings.kb_query_emb_cache_size,
+        result_size=settings.kb_result_cache_size,
+        redis=redis_client if settings.kb_query_cache_redis else None,
+        namespace="kbcache",
+        ttl_seconds=settings.kb_query_cache_ttl_seconds)
+
+query_cache = _build_query_cache()
+
+def _build_rag(kb_dir, index_dir):
+    return HybridRAG(kb_dir=kb_dir,
+        index_dir=index_dir,
         emb_model=settings.kb_emb_model,
+        model_cache=model_cache,
+        model_dir=settings.kb_index_dir / "models",
+        model_backend=settings.kb_model_backend,
+        onnx_quant_config=settings.kb_onnx_quant_config,
+        onnx_min_parity=settings.kb_onnx_min_parity,
+        emb_cache=settings.kb_emb_cache,
+        emb_cache_dtype=settings.kb_emb_cache_dtype,
         chunk_max_chars=settings.kb_chunk_max_chars,
         chunk_overlap_chars=settings.kb_chunk_overlap_chars,
+        ingest_workers=settings.kb_ingest_workers,
+        embed_batch_size=settings.kb_embed_batch_size,
+        query_batch_window_ms=settings.kb_query_batch_window_ms,
+        query_batch_max=settings.kb_query_batch_max,
         hybrid_alpha=settings.kb_hybrid_alpha,
         candidates=settings.kb_candidates,
+        fusion=settings.kb_fusion,
+        rrf_k=settings.kb_rrf_k,
         use_rerank=settings.kb_use_rerank,
         rerank_model=settings.kb_rerank_model,
-        rerank_topn=settings.kb_rerank_topn)
+        rerank_topn=settings.kb_rerank_topn,
+        rerank_batch_size=settings.kb_rerank_batch_size,
+        rerank_budget_ms=settings.kb_rerank_budget_ms,
+        rerank_skip_margin=settings.kb_rerank_skip_margin,
+        rerank_cache_size=settings.kb_rerank_cache_size,
+        ann=AnnParams(kind=settings.kb_ann_index,
+            hnsw_min_chunks=settings.kb_ann_hnsw_min_chunks,
+            ivf_min_chunks=settings.kb_ann_ivf_min_chunks,
+            hnsw_m=settings.kb_ann_hnsw_m,
+            ef_construction=settings.kb_ann_ef_construction,
+            ef_search=settings.kb_ann_ef_search,
+            nprobe=settings.kb_ann_nprobe,
+            pq_m=settings.kb_ann_pq_m,
+            min_recall=settings.kb_ann_min_recall,
+            mmap=settings.kb_faiss_mmap,
+            storage=settings.kb_vector_storage,
+            rescore=settings.kb_vector_rescore),
+        query_cache=query_cache)
+
+def _build_jobs(rag, name):
+    return ReindexJobs(rag, redis=redis_client, collection=name)
+
+def _collection(name, create=False):
+    try:
+        return app.state.collections.get(name, create=create)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UnknownCollection:
+        raise HTTPException(status_code=404, detail=f"Unknown KB collection: {name}")
+
+def _collection_jobs(name, create=False):
+    _collection(name, create=create)
+    return app.state.collections.jobs(name)
+
+def _job_response(job):
+    result = job.pop("result")
+    return ReindexJobResponse(**job,
+        result=ReindexResponse(ok=True, **result) if result is not None else None)
 
 
+def _warm_up():
+    app.state.rag.warm_up()
+    if app.state.router is not None:
+        app.state.router.fit_async()
+
 @app.on_event("startup")
 async def _startup():
-    app.state.rag = _build_rag()
-    app.state.rag.load_if_exists()
+    app.state.collections = CollectionManager(_build_rag, _build_jobs,
+        root=settings.kb_collections_dir,
+        default_kb_dir=settings.kb_dir,
+        default_index_dir=settings.kb_index_dir,
+        memory_budget_bytes=settings.kb_collections_memory_mb << 20,
+        max_loaded=settings.kb_collections_max_loaded)
+    app.state.rag = app.state.collections.get(DEFAULT_COLLECTION)
+    app.state.rag.watch(settings.kb_index_watch_seconds)
+    app.state.router = EmbeddingRouter(app.state.rag.embed_queries, app.state.rag.encode,
+        min_confidence=settings.router_min_confidence,
+        audit_rate=settings.router_audit_rate,
+        examples_path=settings.router_examples_path,
+        log_path=settings.router_log_path if settings.router_log else None,
+        max_log=settings.router_log_max_lines) if settings.router_enabled else None
+    if settings.kb_warmup:
+        threading.Thread(target=_warm_up, name="kb-warmup", daemon=True).start()
+    app.state.reindex_jobs = app.state.collections.jobs(DEFAULT_COLLECTION)
+    app.state.retrieval_pool = RetrievalPool(workers=settings.kb_retrieval_workers,
+        max_queue=settings.kb_retrieval_queue,
+        timeout_s=settings.kb_retrieval_timeout_seconds)
     llm = build_llm_openrouter(api_key=settings.openrouter_api_key,
         model=settings.openrouter_model,
         site_url=settings.openrouter_site_url,
@@ -66,31 +166,89 @@ async def _startup():
         db_agent_llm=llm,
         web_agent_llm=llm,
         rag=app.state.rag,
-        postgres_url=settings.postgres_url)
+        postgres_url=settings.postgres_url,
+        retrieval_pool=app.state.retrieval_pool,
+        collections=app.state.collections,
+        router=app.state.router,
+        speculative=settings.kb_speculative,
+        direct=settings.kb_direct)
+
+@app.on_event("shutdown")
+async def _shutdown():
+    app.state.collections.close()
+    model_cache.close()
+    app.state.retrieval_pool.shutdown()
+
+def _kb_ready(kb):
+    if not settings.kb_warmup:
+        return True
+    return kb["embedder_warm"] and kb["reranker_warm"] is not False
 
 @app.get("/health")
 async def health():
     rag = app.state.rag
-    rag.load_if_exists()
+    kb = rag.status()
     return {"ok": True,
+        "ready": _kb_ready(kb),
         "kb_dir": str(settings.kb_dir),
         "kb_index_dir": str(settings.kb_index_dir),
-        "kb_chunks_loaded": len(getattr(rag, "_chunks", []) or []),
+        "kb_chunks_loaded": kb["chunks"],
+        "kb_generation": kb["generation"],
+        "kb_index": kb,
+        "kb_reindex_jobs": app.state.collections.active_jobs(),
+        "kb_collections": app.state.collections.snapshot(),
+        "kb_query_cache": rag.cache_stats(),
+        "kb_rerank": rag.rerank_stats(),
+        "kb_retrieval": app.state.retrieval_pool.snapshot(),
+        "kb_query_batcher": rag.batcher_stats(),
+        "kb_models": rag.model_stats(),
+        "router": app.state.router.snapshot() if app.state.router is not None else None,
         "redis_url": settings.redis_url,
         "postgres_url": settings.postgres_url,
-        "sql_allow_write": settings.sql_allow_write,
         "model": settings.openrouter_model}
 
-@app.post("/reindex", response_model=ReindexResponse)
-async def reindex():
-    rag = app.state.rag
-    out = rag.reindex()
-    return ReindexResponse(ok=True, docs=out["docs"], chunks=out["chunks"])
+@app.get("/ready")
+async def ready():
+    kb = app.state.rag.status()
+    if not _kb_ready(kb):
+        raise HTTPException(status_code=503, detail="KB models are warming up")
+    return {"ready": True, "kb_generation": kb["generation"], "kb_chunks_loaded": kb["chunks"]}
+
+@app.post("/reindex", response_model=ReindexJobResponse)
+async def reindex(incremental: bool = False, collection: str = Query(DEFAULT_COLLECTION)):
+    return _job_response(_collection_jobs(collection).submit(incremental=incremental))
+
+@app.get("/reindex/jobs/{job_id}", response_model=ReindexJobResponse)
+async def reindex_job(job_id: str):
+    job = app.state.collections.find_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown reindex job: {job_id}")
+    return _job_response(job)
+
+@app.post("/kb/search:batch", response_model=KBSearchBatchResponse)
+async def kb_search_batch(payload: KBSearchBatchRequest):
+    rag = _collection(payload.collection)
+    filters = SearchFilter.build(**payload.filters.model_dump()) if payload.filters else None
+    try:
+        results = await app.state.retrieval_pool.run(rag.search_batch, payload.queries, k=payload.k, filters=filters)
+    except RetrievalBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="KB search timed out")
+    return KBSearchBatchResponse(results=results)
+
+@app.get("/kb/collections")
+async def kb_collections():
+    collections = app.state.collections
+    loaded = {c["name"]: c for c in collections.snapshot()["loaded"]}
+    return {"collections": [{"name": name, "loaded": name in loaded, **loaded.get(name, {})}
+        for name in collections.names()]}
 
 @app.post("/kb/upload", response_model=UploadResponse)
-async def kb_upload(files: list[UploadFile] = File(...)):
+async def kb_upload(files: list[UploadFile] = File(...), collection: str = Query(DEFAULT_COLLECTION)):
     if not files:
         raise HTTPException(status_code=400, detail="No files uploaded")
+    kb_dir = _collection(collection, create=True).kb_dir
 
     saved = []
     for f in files:
@@ -103,16 +261,15 @@ async def kb_upload(files: list[UploadFile] = File(...)):
         if len(data) > settings.kb_max_upload_bytes:
             raise HTTPException(status_code=413, detail=f"File too large: {fn}")
 
-        out_path = settings.kb_dir / fn
+        out_path = kb_dir / fn
         out_path.parent.mkdir(parents=True, exist_ok=True)
         out_path.write_bytes(data)
         saved.append({"filename": fn, "bytes": len(data)})
 
-    rag = app.state.rag
-    out = rag.reindex()
+    job = _collection_jobs(collection).submit(incremental=True)
     return UploadResponse(ok=True,
         saved=saved,
-        reindex=ReindexResponse(ok=True, docs=out["docs"], chunks=out["chunks"]),)
+        job=_job_response(job),)
 
 @app.get("/sessions", response_model=list[SessionInfo])
 async def sessions_list():
@@ -177,6 +334,34 @@ async def session_messages(session_id: str, limit: int = 200):
         out.append({"role": role, "content": content})
     return {"session_id": session_id, "messages": out}
 
+def _final_answer(result_state):
+    msgs = getattr(result_state, "messages", None)
+    if msgs is None and isinstance(result_state, dict):
+        msgs = result_state.get("messages") or []
+    msgs = msgs or []
+    return (msgs[-1].content if msgs else "").strip()
+
+def _save_turn(history, session_id, question, answer):
+    history.add_user_message(question)
+    history.add_ai_message(answer)
+
+    cur_title = get_title(redis_client, session_id)
+    if cur_title == "New chat":
+        set_title(redis_client, session_id, _auto_title(question))
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def _chunk_text(chunk):
+    content = getattr(chunk, "content", "") or ""
+    if isinstance(content, list):
+        return "".join(p.get("text", "") if isinstance(p, dict) else str(p) for p in content)
+    return content
+
+def _preview(output, max_chars=500):
+    text = str(getattr(output, "content", output) or "")
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
 @app.post("/sessions/{session_id}/ask", response_model=AskResponse)
 async def ask(session_id: str, payload: AskRequest):
     if not settings.openrouter_api_key:
@@ -186,22 +371,82 @@ async def ask(session_id: str, payload: AskRequest):
     prior = _trim_messages(history.messages, settings.chat_max_turns)
     
     graph = app.state.graph
-    state_in = {"messages": prior + [HumanMessage(content=payload.question)]}
+    state_in = {"messages": prior + [HumanMessage(content=payload.question)], "kb_k": payload.k}
     result_state = await graph.ainvoke(state_in)
+    answer = _final_answer(result_state)
 
-    msgs = getattr(result_state, "messages", None)
-    if msgs is None and isinstance(result_state, dict):
-        msgs = result_state.get("messages") or []
-    msgs = msgs or []
-    answer = (msgs[-1].content if msgs else "").strip()
-
-    history.add_user_message(payload.question)
-    history.add_ai_message(answer)
-
-    cur_title = get_title(redis_client, session_id)
-    if cur_title == "New chat":
-        set_title(redis_client, session_id, _auto_title(payload.question))
+    _save_turn(history, session_id, payload.question, answer)
 
+    sources = result_state.get("kb_sources") if isinstance(result_state, dict) else None
     return AskResponse(session_id=session_id,
         answer=(answer or "").strip(),
+        sources=[{"source": s} for s in sources or []],
         error=None)
+
+@app.post("/sessions/{session_id}/ask:stream")
+async def ask_stream(session_id: str, payload: AskRequest):
+    if not settings.openrouter_api_key:
+        raise HTTPException(status_code=500, detail="OPENROUTER_API_KEY is not set")
+
+    history = get_history(settings.redis_url, session_id)
+    prior = _trim_messages(history.messages, settings.chat_max_turns)
+    state_in = {"messages": prior + [HumanMessage(content=payload.question)], "kb_k": payload.k}
+
+    async def events():
+        started = time.perf_counter()
+        first_token_ms = None
+        route = ""
+        tools_used = []
+        tokens = []
+        final = None
+        held, direct_gate = "", ""
+        try:
+            async for ev in app.state.graph.astream_events(state_in, version="v2"):
+                kind = ev["event"]
+                data = ev.get("data") or {}
+                if kind == "on_chain_end" and ev["name"] == "planner":
+                    out = data.get("output") or {}
+                    route = out.get("route", "")
+                    yield _sse("route", {"route": route, "by": out.get("route_by", "")})
+                elif kind == "on_tool_start":
+                    tools_used.append(ev["name"])
+                    tokens = []
+                    yield _sse("tool_start", {"name": ev["name"], "input": data.get("input")})
+                elif kind == "on_tool_end":
+                    yield _sse("tool_end", {"name": ev["name"], "output": _preview(data.get("output"))})
+                elif kind == "on_chat_model_stream" and "planner" not in (ev.get("tags") or []):
+                    text = _chunk_text(data.get("chunk"))
+                    if text and "kb_direct" in (ev.get("tags") or []) and direct_gate != "pass":
+                        # hold back the direct answer until it is clear it is not a request for more retrieval
+                        held += text
+                        head = held.lstrip()
+                        if direct_gate == "drop" or head.startswith(KB_MORE_MARKER):
+                            direct_gate = "drop"
+                            continue
+                        if KB_MORE_MARKER.startswith(head):
+                            continue
+                        direct_gate, text = "pass", held
+                    if text:
+                        if first_token_ms is None:
+                            first_token_ms = (time.perf_counter() - started) * 1000
+                        tokens.append(text)
+                        yield _sse("token", {"text": text})
+                elif kind == "on_chain_end" and not ev.get("parent_ids"):
+                    final = data.get("output")
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+            return
+
+        answer = _final_answer(final) if final is not None else "".join(tokens).strip()
+        _save_turn(history, session_id, payload.question, answer)
+        sources = final.get("kb_sources") if isinstance(final, dict) else None
+        yield _sse("done", {"session_id": session_id,
+            "answer": answer,
+            "sources": [{"source": s} for s in sources or []],
+            "tools_used": tools_used,
+            "route": route,
+            "ttft_ms": first_token_ms,
+            "total_ms": (time.perf_counter() - started) * 1000})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,175 @@
+import math
+from dataclasses import dataclass
+
+import numpy as np
+import faiss
+
+_ADD_BATCH = 65536
+
+@dataclass
+class AnnParams:
+    kind: str = "auto"
+    hnsw_min_chunks: int = 50000
+    ivf_min_chunks: int = 1000000
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    nprobe: int = 16
+    pq_m: int = 0
+    min_recall: float = 0.9
+    recall_k: int = 10
+    recall_sample: int = 200
+    mmap: bool = True
+    storage: str = "float32"
+    rescore: int = 4
+
+_CODECS = {"float16": "SQfp16", "sq8": "SQ8"}
+
+def choose_kind(n, p: AnnParams):
+    if p.kind != "auto":
+        return p.kind
+    if n >= p.ivf_min_chunks:
+        return "ivfpq"
+    if n >= p.hnsw_min_chunks:
+        return "hnsw"
+    return "flat"
+
+def _pq_m(dim, want):
+    if want and dim % want == 0:
+        return want
+    for m in range(max(1, dim // 8), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+def _codec(dim, p: AnnParams):
+    if p.storage == "pq":
+        return f"PQ{_pq_m(dim, p.pq_m)}"
+    return _CODECS[p.storage]
+
+def _train(index, emb, n_train):
+    n = len(emb)
+    rng = np.random.default_rng(0)
+    train = emb if n_train >= n else emb[np.sort(rng.choice(n, size=n_train, replace=False))]
+    index.train(np.ascontiguousarray(train))
+
+def _add(index, emb):
+    for i in range(0, len(emb), _ADD_BATCH):
+        index.add(np.ascontiguousarray(emb[i:i + _ADD_BATCH]))
+
+def _build(emb, kind, p: AnnParams):
+    n, dim = emb.shape
+    if kind == "hnsw":
+        if p.storage == "float32":
+            index = faiss.IndexHNSWFlat(dim, p.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.index_factory(dim, f"HNSW{p.hnsw_m}_{_codec(dim, p)}", faiss.METRIC_INNER_PRODUCT)
+        faiss.downcast_index(index).hnsw.efConstruction = p.ef_construction
+    elif kind == "ivfpq":
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+        index = faiss.index_factory(dim, f"IVF{nlist},PQ{_pq_m(dim, p.pq_m)}", faiss.METRIC_INNER_PRODUCT)
+        _train(index, emb, max(nlist * 64, 50000))
+    elif p.storage == "float32":
+        index = faiss.IndexFlatIP(dim)
+    else:
+        index = faiss.index_factory(dim, _codec(dim, p), faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        _train(index, emb, 50000)
+    _add(index, emb)
+    return index
+
+def set_search_params(index, nprobe, ef_search):
+    ix = faiss.downcast_index(index)
+    if isinstance(ix, faiss.IndexHNSW):
+        ix.hnsw.efSearch = int(ef_search)
+    elif isinstance(ix, faiss.IndexIVF):
+        ix.nprobe = int(nprobe)
+
+def _search_params(index, selector, selectivity):
+    ix = faiss.downcast_index(index)
+    if isinstance(ix, faiss.IndexHNSW):
+        ef = ix.hnsw.efSearch
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=int(min(16 * ef, ef / max(selectivity, 1e-9))))
+    if isinstance(ix, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ix.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+def filtered_search(index, q, k, mask):
+    bits = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bits))
+    return index.search(q, k, params=_search_params(index, selector, mask.mean() if len(mask) else 1.0))
+
+def is_exact_flat(index):
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+def can_remove(index):
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlatCodes)
+
+def storage_key(kind, p: AnnParams):
+    return f"{kind}/{'pq' if kind == 'ivfpq' else p.storage}"
+
+def rescore(vectors, q, ids, n):
+    out_scores = np.full((len(q), n), -np.inf, dtype=np.float32)
+    out_ids = np.full((len(q), n), -1, dtype=np.int64)
+    for qi in range(len(q)):
+        cand = np.sort(ids[qi][ids[qi] >= 0])
+        if not len(cand):
+            continue
+        exact = np.asarray(vectors[cand], dtype=np.float32) @ q[qi]
+        top = np.argsort(-exact, kind="stable")[:n]
+        out_scores[qi, :len(top)] = exact[top]
+        out_ids[qi, :len(top)] = cand[top]
+    return out_scores, out_ids
+
+def recall_at_k(index, base, queries, k=10, rescore_factor=1):
+    k = min(k, len(base))
+    if not len(queries) or k <= 0:
+        return 1.0
+    q = np.ascontiguousarray(queries)
+    _, exact = faiss.knn(q, base, k, metric=faiss.METRIC_INNER_PRODUCT)
+    if rescore_factor > 1:
+        _, cand = index.search(q, min(len(base), k * rescore_factor))
+        _, approx = rescore(base, q, cand, k)
+    else:
+        _, approx = index.search(q, k)
+    found = sum(len(set(a) & set(e)) for a, e in zip(approx.tolist(), exact.tolist()))
+    return found / (len(q) * k)
+
+def build_index(emb, p: AnnParams):
+    n = len(emb)
+    kind = choose_kind(n, p)
+    storage = storage_key(kind, p).split("/")[1]
+    info = {"kind": kind, "storage": storage, "nprobe": p.nprobe, "ef_search": p.ef_search, "recall": 1.0}
+    if kind == "flat" and storage == "float32":
+        return _build(emb, kind, p), info
+
+    # recall is measured on held-out rows: a query that is itself in the index finds its own
+    # neighbourhood far too easily. The tail is held out so ids stay row positions once it is added.
+    head = n - min(p.recall_sample, n // 10)
+    base = emb[:head]
+    index = _build(base, kind, p)
+    factor = max(1, p.rescore) if p.storage != "float32" else 1
+    info["rescore"] = factor
+    set_search_params(index, info["nprobe"], info["ef_search"])
+    info["recall"] = recall_at_k(index, base, emb[head:], p.recall_k, factor)
+    for _ in range(3 if kind != "flat" else 0):
+        if info["recall"] >= p.min_recall:
+            break
+        info["nprobe"] *= 2
+        info["ef_search"] *= 2
+        set_search_params(index, info["nprobe"], info["ef_search"])
+        info["recall"] = recall_at_k(index, base, emb[head:], p.recall_k, factor)
+
+    if info["recall"] < p.min_recall:
+        info = {"kind": "flat", "storage": "float32", "nprobe": p.nprobe, "ef_search": p.ef_search, "recall": 1.0,
+            "fallback_from": f"{kind}/{storage}", "fallback_recall": info["recall"]}
+        index = faiss.IndexFlatIP(emb.shape[1])
+        _add(index, emb)
+    else:
+        _add(index, emb[head:])
+    return index, info
+
+def mmap_flags(kind):
+    if kind == "ivfpq":
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
@@ -0,0 +1,112 @@
+import json
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+from sentence_transformers import SentenceTransformer, CrossEncoder
+
+BACKENDS = ("torch", "onnx-int8")
+
+PARITY_TEXTS = [
+    "How to restart the docker container after an out of memory error?",
+    "Connection refused when connecting to PostgreSQL on port 5432",
+    "Redis maxmemory policy allkeys-lru evicts session keys",
+    "Как откатить миграцию базы данных на предыдущую версию?",
+    "Ошибка 502 Bad Gateway после деплоя nginx",
+    "Чеклист перед релизом: бэкап, миграции, smoke-тесты",
+    "kubectl rollout undo deployment/api --to-revision=3",
+    "Timeout while waiting for the health check to pass",
+]
+
+def model_id(model_name, backend="torch", quant_config="avx2"):
+    if backend == "torch":
+        return model_name
+    return f"{model_name}#{backend}-{quant_config}"
+
+def _slug(name):
+    return re.sub(r"[^a-zA-Z0-9._-]+", "_", name)
+
+def _quant_file(quant_config):
+    return f"onnx/model_qint8_{quant_config}.onnx"
+
+def _export(cls, model_name, target: Path, quant_config):
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model = cls(model_name, backend="onnx")
+    model.save(str(target))
+    export_dynamic_quantized_onnx_model(model, quant_config, str(target))
+
+def _embedder_parity(model_name, quantized, texts):
+    ref = SentenceTransformer(model_name).encode(texts, normalize_embeddings=True, show_progress_bar=False)
+    got = quantized.encode(texts, normalize_embeddings=True, show_progress_bar=False)
+    return float(np.min(np.sum(np.asarray(ref) * np.asarray(got), axis=1)))
+
+def _reranker_parity(model_name, quantized, texts):
+    pairs = [[q, t] for q in texts[:4] for t in texts]
+    ref = np.asarray(CrossEncoder(model_name).predict(pairs, show_progress_bar=False), dtype=np.float64)
+    got = np.asarray(quantized.predict(pairs, show_progress_bar=False), dtype=np.float64)
+    if np.std(ref) < 1e-9 or np.std(got) < 1e-9:
+        return float(np.allclose(ref, got, atol=1e-3))
+    return float(np.corrcoef(ref, got)[0, 1])
+
+def load_model(kind, model_name, backend="torch", cache_dir: Path | None = None,
+        quant_config="avx2", min_parity=0.98, parity_texts=None):
+    cls = SentenceTransformer if kind == "embedder" else CrossEncoder
+    if backend == "torch":
+        return cls(model_name), {"backend": "torch"}
+    if backend != "onnx-int8":
+        raise ValueError(f"Unknown model backend: {backend}")
+
+    target = cache_dir / f"{kind}-{_slug(model_name)}"
+    parity_path = target / f"parity_{quant_config}.json"
+    try:
+        if not (target / _quant_file(quant_config)).exists():
+            _export(cls, model_name, target, quant_config)
+            parity_path.unlink(missing_ok=True)
+        model = cls(str(target), backend="onnx", model_kwargs={"file_name": _quant_file(quant_config)})
+    except ImportError as e:
+        return cls(model_name), {"backend": "torch", "fallback_from": backend, "error": str(e)}
+
+    if parity_path.exists():
+        info = json.loads(parity_path.read_text(encoding="utf-8"))
+    else:
+        texts = list(parity_texts or PARITY_TEXTS)
+        check = _embedder_parity if kind == "embedder" else _reranker_parity
+        info = {"backend": backend, "quant_config": quant_config, "parity": check(model_name, model, texts),
+            "samples": len(texts)}
+        parity_path.write_text(json.dumps(info), encoding="utf-8")
+
+    info["min_parity"] = min_parity
+    if info["parity"] < min_parity:
+        return cls(model_name), {**info, "backend": "torch", "fallback_from": backend}
+    return model, info
+
+class ModelCache:
+    def __init__(self):
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            if key in self._models:
+                return self._models[key]
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            with self._lock:
+                if key in self._models:
+                    return self._models[key]
+            model = load()
+            with self._lock:
+                self._models[key] = model
+                self._locks.pop(key, None)
+            return model
+
+    def close(self):
+        with self._lock:
+            values = list(self._models.values())
+            self._models.clear()
+        for v in values:
+            if hasattr(v, "close"):
+                v.close()
@@ -0,0 +1,91 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+class EmbeddingBatcher:
+    def __init__(self, encode, window_ms=3, max_batch=64):
+        self._encode = encode
+        self.window_s = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self._q = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {"requests": 0, "texts": 0, "batches": 0, "max_batch": 0, "queue_ms_total": 0.0, "encode_ms_total": 0.0}
+        self._thread = threading.Thread(target=self._run, name="kb-query-batcher", daemon=True)
+        self._thread.start()
+
+    def encode(self, texts):
+        fut = Future()
+        with self._lock:
+            if self._closed:
+                return np.asarray(self._encode(list(texts)), dtype=np.float32)
+            self._q.put((list(texts), fut, time.perf_counter()))
+        return fut.result()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._q.put(None)
+
+    def _collect(self):
+        first = self._q.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        n = len(first[0])
+        deadline = time.perf_counter() + self.window_s
+        while n < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+            n += len(item[0])
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if not batch:
+                break
+            texts = [t for b in batch for t in b[0]]
+            started = time.perf_counter()
+            try:
+                emb = np.asarray(self._encode(texts), dtype=np.float32)
+            except Exception as e:
+                for _, fut, _ in batch:
+                    fut.set_exception(e)
+                continue
+            done = time.perf_counter()
+
+            i = 0
+            for items, fut, _ in batch:
+                fut.set_result(emb[i:i + len(items)])
+                i += len(items)
+
+            with self._lock:
+                self.stats["requests"] += len(batch)
+                self.stats["texts"] += len(texts)
+                self.stats["batches"] += 1
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(texts))
+                self.stats["queue_ms_total"] += sum(started - t0 for _, _, t0 in batch) * 1000
+                self.stats["encode_ms_total"] += (done - started) * 1000
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+        batches = out["batches"] or 1
+        out["avg_batch"] = out["texts"] / batches
+        out["avg_queue_ms"] = out["queue_ms_total"] / max(1, out["requests"])
+        out["avg_encode_ms"] = out["encode_ms_total"] / batches
+        out["window_ms"] = self.window_s * 1000
+        return out
@@ -0,0 +1,166 @@
+import numpy as np
+
+# Okapi BM25 over CSR posting lists (term -> sorted doc ids + term frequencies).
+# Scoring matches rank_bm25.BM25Okapi (same idf floor and defaults), but a query
+# only touches the postings of its own terms.
+
+_EMPTY_I = np.zeros(0, dtype=np.int32)
+_EMPTY_F = np.zeros(0, dtype=np.float32)
+_EMPTY_RESULT = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+
+def _select(docs, scores, n):
+    n = min(n, len(docs))
+    top = np.argpartition(-scores, n - 1)[:n]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return docs[top].astype(np.int64), scores[top].astype(np.float32)
+
+def _csr_from_tokens(flat, offsets, n_terms):
+    flat = np.asarray(flat, dtype=np.int64)
+    doc_len = np.diff(np.asarray(offsets, dtype=np.int64))
+    n_docs = len(doc_len)
+    ptr = np.zeros(n_terms + 1, dtype=np.int64)
+    if not n_docs or not len(flat):
+        return ptr, _EMPTY_I, _EMPTY_F, doc_len.astype(np.float32)
+
+    doc = np.repeat(np.arange(n_docs, dtype=np.int64), doc_len)
+    keys, tf = np.unique(flat * n_docs + doc, return_counts=True)
+    terms = keys // n_docs
+    np.cumsum(np.bincount(terms, minlength=n_terms), out=ptr[1:])
+    return ptr, (keys % n_docs).astype(np.int32), tf.astype(np.float32), doc_len.astype(np.float32)
+
+def _pad_ptr(ptr, n_terms):
+    if len(ptr) - 1 >= n_terms:
+        return ptr
+    return np.concatenate([ptr, np.full(n_terms + 1 - len(ptr), ptr[-1], dtype=np.int64)])
+
+class SparseBM25:
+    def __init__(self, ptr, docs, tf, doc_len, k1=1.5, b=0.75, epsilon=0.25):
+        self.ptr = ptr
+        self.docs = docs
+        self.tf = tf
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.n_docs = len(doc_len)
+        self.n_terms = len(ptr) - 1
+        df = np.diff(np.asarray(ptr, dtype=np.int64))
+        present = df > 0
+        idf = np.zeros(self.n_terms, dtype=np.float32)
+        if present.any():
+            raw = np.log(self.n_docs - df[present] + 0.5) - np.log(df[present] + 0.5)
+            raw[raw < 0] = epsilon * raw.mean()
+            idf[present] = raw
+        self.idf = idf
+
+        avgdl = float(np.mean(doc_len)) if self.n_docs else 0.0
+        if avgdl > 0:
+            self.norm = (k1 * (1 - b + b * np.asarray(doc_len, dtype=np.float32) / avgdl)).astype(np.float32)
+        else:
+            self.norm = np.full(self.n_docs, k1 * (1 - b), dtype=np.float32)
+
+    @classmethod
+    def from_token_ids(cls, flat, offsets, n_terms, **kw):
+        return cls(*_csr_from_tokens(flat, offsets, n_terms), **kw)
+
+    @classmethod
+    def from_token_lists(cls, token_ids, n_terms, **kw):
+        offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in token_ids], out=offsets[1:])
+        flat = np.concatenate([np.asarray(t, dtype=np.int64) for t in token_ids]) if token_ids else _EMPTY_I
+        return cls.from_token_ids(flat, offsets, n_terms, **kw)
+
+    def _params(self):
+        return {"k1": self.k1, "b": self.b, "epsilon": self.epsilon}
+
+    def arrays(self):
+        return {"bm25.ptr": np.asarray(self.ptr), "bm25.docs": np.asarray(self.docs),
+            "bm25.tf": np.asarray(self.tf), "bm25.doc_len": np.asarray(self.doc_len)}
+
+    def appended(self, flat, offsets, n_terms):
+        n_terms = max(n_terms, self.n_terms)
+        other = SparseBM25.from_token_ids(flat, offsets, n_terms)
+        a_ptr = _pad_ptr(np.asarray(self.ptr, dtype=np.int64), n_terms)
+        a_cnt = np.diff(a_ptr)
+        b_cnt = np.diff(other.ptr)
+
+        ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(a_cnt + b_cnt, out=ptr[1:])
+        docs = np.empty(int(ptr[-1]), dtype=np.int32)
+        tf = np.empty(int(ptr[-1]), dtype=np.float32)
+
+        a_terms = np.repeat(np.arange(n_terms), a_cnt)
+        a_pos = ptr[a_terms] + np.arange(len(a_terms)) - a_ptr[a_terms]
+        docs[a_pos] = self.docs
+        tf[a_pos] = self.tf
+
+        b_terms = np.repeat(np.arange(n_terms), b_cnt)
+        b_pos = ptr[b_terms] + a_cnt[b_terms] + np.arange(len(b_terms)) - other.ptr[b_terms]
+        docs[b_pos] = other.docs + self.n_docs
+        tf[b_pos] = other.tf
+
+        doc_len = np.concatenate([np.asarray(self.doc_len), other.doc_len]).astype(np.float32)
+        return SparseBM25(ptr, docs, tf, doc_len, **self._params())
+
+    def without(self, drop_mask):
+        drop_mask = np.asarray(drop_mask, dtype=bool)
+        remap = np.cumsum(~drop_mask) - 1
+        docs = np.asarray(self.docs)
+        keep = ~drop_mask[docs]
+        terms = np.repeat(np.arange(self.n_terms), np.diff(np.asarray(self.ptr, dtype=np.int64)))
+        ptr = np.zeros(self.n_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms[keep], minlength=self.n_terms), out=ptr[1:])
+        doc_len = np.asarray(self.doc_len)[~drop_mask].astype(np.float32)
+        return SparseBM25(ptr, remap[docs[keep]].astype(np.int32),
+            np.asarray(self.tf)[keep], doc_len, **self._params())
+
+    def _postings(self, query_ids, mask=None):
+        k1p = self.k1 + 1
+        for t in query_ids:
+            if t < 0 or t >= self.n_terms:
+                continue
+            a, b = int(self.ptr[t]), int(self.ptr[t + 1])
+            if a == b:
+                continue
+            d = self.docs[a:b]
+            tf = self.tf[a:b]
+            if mask is not None:
+                keep = mask[d]
+                if not keep.any():
+                    continue
+                d, tf = d[keep], tf[keep]
+            yield d, self.idf[t] * tf * k1p / (tf + self.norm[d])
+
+    def top_n(self, query_ids, n, mask=None):
+        parts = list(self._postings(query_ids, mask))
+        if not parts or n <= 0:
+            return _EMPTY_RESULT
+        docs = np.concatenate([d for d, _ in parts])
+        scores = np.concatenate([s for _, s in parts])
+        if len(parts) > 1:
+            docs, inv = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inv, weights=scores)
+        return _select(docs, scores, n)
+
+    def top_n_batch(self, queries, n, mask=None):
+        parts_q = []
+        parts_d = []
+        parts_s = []
+        for qi, query_ids in enumerate(queries):
+            for d, sc in self._postings(query_ids, mask):
+                parts_q.append(np.full(len(d), qi, dtype=np.int64))
+                parts_d.append(d)
+                parts_s.append(sc)
+        if not parts_d or n <= 0:
+            return [_EMPTY_RESULT for _ in queries]
+
+        keys = np.concatenate(parts_q) * self.n_docs + np.concatenate(parts_d)
+        keys, inv = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inv, weights=np.concatenate(parts_s))
+        bounds = np.searchsorted(keys // self.n_docs, np.arange(len(queries) + 1))
+        out = []
+        for qi in range(len(queries)):
+            a, b = bounds[qi], bounds[qi + 1]
+            out.append(_select(keys[a:b] % self.n_docs, scores[a:b], n) if b > a else _EMPTY_RESULT)
+        return out
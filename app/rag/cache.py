@@ -0,0 +1,124 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def normalize_query(q):
+    return " ".join((q or "").lower().split())
+
+def query_hash(*parts):
+    return hashlib.blake2b("\x1f".join(str(p) for p in parts).encode("utf-8"), digest_size=16).hexdigest()
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class QueryCache:
+    def __init__(self, emb_size=4096, result_size=1024, redis=None, namespace="kb", ttl_seconds=3600):
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self._emb = LRUCache(emb_size)
+        self._results = LRUCache(result_size)
+        self._generation = None
+        self._lock = threading.Lock()
+        self.stats = {"emb_hits": 0, "emb_misses": 0, "result_hits": 0, "result_misses": 0, "redis_hits": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _redis_get(self, key):
+        if self.redis is None:
+            return None
+        try:
+            return self.redis.get(key)
+        except Exception:
+            return None
+
+    def _redis_set(self, key, value):
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(key, value, ex=self.ttl_seconds)
+        except Exception:
+            pass
+
+    def _emb_key(self, model, q):
+        return f"{self.namespace}:qemb:{query_hash(model, normalize_query(q))}"
+
+    def _result_key(self, q, k, generation, config):
+        return f"{self.namespace}:res:{generation}:{query_hash(normalize_query(q), k, config)}"
+
+    def get_embedding(self, model, q):
+        key = self._emb_key(model, q)
+        vec = self._emb.get(key)
+        if vec is None:
+            raw = self._redis_get(key)
+            if raw is not None:
+                vec = np.frombuffer(raw, dtype=np.float32)
+                self._emb.put(key, vec)
+                self._count("redis_hits")
+        self._count("emb_hits" if vec is not None else "emb_misses")
+        return vec
+
+    def put_embedding(self, model, q, vec):
+        key = self._emb_key(model, q)
+        vec = np.asarray(vec, dtype=np.float32)
+        self._emb.put(key, vec)
+        self._redis_set(key, vec.tobytes())
+
+    def get_results(self, q, k, generation, config=""):
+        # no clear on a new build_id: the cache is shared by collections, old keys age out of the LRU
+        self._generation = generation
+        key = self._result_key(q, k, generation, config)
+        hits = self._results.get(key)
+        if hits is None:
+            raw = self._redis_get(key)
+            if raw is not None:
+                hits = json.loads(raw)
+                self._results.put(key, hits)
+                self._count("redis_hits")
+        self._count("result_hits" if hits is not None else "result_misses")
+        return [dict(h) for h in hits] if hits is not None else None
+
+    def put_results(self, q, k, generation, hits, config=""):
+        key = self._result_key(q, k, generation, config)
+        hits = [dict(h) for h in hits]
+        self._results.put(key, hits)
+        self._redis_set(key, json.dumps(hits, ensure_ascii=False))
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+        out["emb_entries"] = len(self._emb)
+        out["result_entries"] = len(self._results)
+        out["generation"] = self._generation
+        return out
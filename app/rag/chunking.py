@@ -0,0 +1,75 @@
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+from .loaders import iter_segments
+
+@dataclass
+class Chunk:
+    doc_id: str
+    source: str
+    chunk_id: str
+    title: str
+    text: str
+    page: int | None = None
+    row_start: int | None = None
+    row_end: int | None = None
+
+_heading_re = re.compile(r"^(#{1,6})\s+(.*)$", re.MULTILINE)
+
+def _split_md_by_headings(text):
+    matches = list(_heading_re.finditer(text))
+    if not matches:
+        return [("Document", text.strip())]
+    out = []
+    for i, m in enumerate(matches):
+        start = m.start()
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        title = (m.group(2) or "").strip() or "Section"
+        body = text[start:end].strip()
+        out.append((title, body))
+    return out
+
+def _chunk_text(title, body, max_chars, overlap):
+    body = re.sub(r"\s+", " ", body).strip()
+    if not body:
+        return []
+    chunks = []
+    i = 0
+    n = len(body)
+    while i < n:
+        j = min(i + max_chars, n)
+        piece = body[i:j].strip()
+        if piece:
+            chunks.append((title, piece))
+        if j == n:
+            break
+        i = max(0, j - overlap)
+    return chunks
+
+def iter_doc_chunks(path: Path, kb_dir: Path, max_chars, overlap, failed=None):
+    rel = path.relative_to(kb_dir).as_posix()
+    local_i = 0
+    try:
+        for seg in iter_segments(path, max_chars):
+            sections = [(seg.title, seg.text)] if seg.title else _split_md_by_headings(seg.text)
+            for title, sec in sections:
+                for title2, piece in _chunk_text(title, sec, max_chars, overlap):
+                    yield Chunk(
+                        doc_id=rel,
+                        source=rel,
+                        chunk_id=f"{rel}::c{local_i:04d}",
+                        title=title2,
+                        text=piece,
+                        page=seg.page,
+                        row_start=seg.row_start,
+                        row_end=seg.row_end,
+                    )
+                    local_i += 1
+    except Exception:
+        if failed is not None:
+            failed.append(path)
+
+def load_doc_chunks(path: Path, kb_dir: Path, max_chars, overlap):
+    failed = []
+    return list(iter_doc_chunks(path, kb_dir, max_chars, overlap, failed)), bool(failed)
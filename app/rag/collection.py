@@ -0,0 +1,145 @@
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+DEFAULT_COLLECTION = "default"
+
+_name_re = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+
+class UnknownCollection(KeyError):
+    pass
+
+class CollectionManager:
+    def __init__(self, factory, jobs_factory, root: Path, default_kb_dir: Path, default_index_dir: Path,
+            memory_budget_bytes=0, max_loaded=0):
+        self.factory = factory
+        self.jobs_factory = jobs_factory
+        self.root = root
+        self.default_kb_dir = default_kb_dir
+        self.default_index_dir = default_index_dir
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_loaded = max_loaded
+        self._loaded = OrderedDict()
+        self._loading = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "loads": 0, "evictions": 0}
+
+    def check_name(self, name):
+        name = (name or DEFAULT_COLLECTION).strip().lower()
+        if not _name_re.match(name):
+            raise ValueError(f"Bad collection name: {name!r} (use a-z, 0-9, '-' and '_')")
+        return name
+
+    def paths(self, name):
+        if name == DEFAULT_COLLECTION:
+            return self.default_kb_dir, self.default_index_dir
+        return self.root / name / "kb", self.root / name / "index"
+
+    def names(self):
+        names = {DEFAULT_COLLECTION}
+        if self.root.exists():
+            names.update(p.name for p in self.root.iterdir() if (p / "kb").is_dir() and _name_re.match(p.name))
+        return sorted(names)
+
+    def get(self, name=None, create=False):
+        name = self.check_name(name)
+        with self._lock:
+            rag = self._touch(name)
+            if rag is not None:
+                return rag
+            load_lock = self._loading.setdefault(name, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                rag = self._touch(name)
+                if rag is not None:
+                    return rag
+            kb_dir, index_dir = self.paths(name)
+            if not kb_dir.is_dir():
+                if not create:
+                    raise UnknownCollection(name)
+                kb_dir.mkdir(parents=True, exist_ok=True)
+            index_dir.mkdir(parents=True, exist_ok=True)
+            rag = self.factory(kb_dir, index_dir)
+            rag.load_if_exists()
+
+            with self._lock:
+                self._loaded[name] = rag
+                self.stats["loads"] += 1
+                jobs = self._jobs.get(name)
+                if jobs is not None:
+                    jobs.rag = rag
+                evicted = self._evict(keep=name)
+        for old in evicted:
+            old.close()
+        return rag
+
+    def _touch(self, name):
+        rag = self._loaded.get(name)
+        if rag is not None:
+            self._loaded.move_to_end(name)
+            self.stats["hits"] += 1
+        return rag
+
+    def _over_budget(self):
+        if self.max_loaded and len(self._loaded) > self.max_loaded:
+            return True
+        return bool(self.memory_budget_bytes) \
+            and sum(r.memory_bytes() for r in self._loaded.values()) > self.memory_budget_bytes
+
+    def _evict(self, keep):
+        evicted = []
+        for name in list(self._loaded):
+            if not self._over_budget():
+                break
+            if name in (keep, DEFAULT_COLLECTION):
+                continue
+            jobs = self._jobs.get(name)
+            if jobs is not None and jobs.active():
+                continue
+            evicted.append(self._loaded.pop(name))
+            self.stats["evictions"] += 1
+        return evicted
+
+    def jobs(self, name=None, create=False):
+        rag = self.get(name, create)
+        name = self.check_name(name)
+        with self._lock:
+            jobs = self._jobs.get(name)
+            if jobs is None:
+                jobs = self._jobs[name] = self.jobs_factory(rag, name)
+            return jobs
+
+    def find_job(self, job_id):
+        with self._lock:
+            all_jobs = list(self._jobs.values())
+        for jobs in all_jobs:
+            job = jobs.get(job_id, remote=False)
+            if job is not None:
+                return job
+        return all_jobs[0].get(job_id) if all_jobs else None
+
+    def active_jobs(self):
+        with self._lock:
+            all_jobs = list(self._jobs.values())
+        return [j for jobs in all_jobs for j in jobs.active()]
+
+    def snapshot(self):
+        with self._lock:
+            loaded = list(self._loaded.items())
+            out = dict(self.stats)
+        out["loaded"] = [{"name": name, "memory_bytes": rag.memory_bytes(), "chunks": rag.status()["chunks"]}
+            for name, rag in reversed(loaded)]
+        out["memory_bytes"] = sum(c["memory_bytes"] for c in out["loaded"])
+        out["memory_budget_bytes"] = self.memory_budget_bytes
+        out["max_loaded"] = self.max_loaded
+        return out
+
+    def close(self):
+        with self._lock:
+            loaded = list(self._loaded.values())
+            self._loaded.clear()
+        for rag in loaded:
+            rag.close()
@@ -0,0 +1,154 @@
+import hashlib
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+def text_key(text):
+    norm = " ".join((text or "").split())
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=16).hexdigest().encode("ascii")
+
+def _slug(model):
+    return re.sub(r"[^a-zA-Z0-9_.-]+", "_", model)
+
+def _save_npy(path: Path, arr):
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, path)
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: Path, model: str, dtype="float16"):
+        self.cache_dir = cache_dir
+        self.model = model
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+
+        self._pos = None
+        self._vecs = None
+        self._new_keys = []
+        self._new_dim = None
+        self._new_f = None
+
+    @property
+    def _keys_path(self):
+        return self.cache_dir / f"{_slug(self.model)}.keys.npy"
+
+    @property
+    def _vecs_path(self):
+        return self.cache_dir / f"{_slug(self.model)}.{self.dtype.name}.npy"
+
+    @property
+    def _new_path(self):
+        return self.cache_dir / f"{_slug(self.model)}.{self.dtype.name}.new.tmp"
+
+    def _ensure_loaded(self):
+        if self._pos is not None:
+            return
+        self._pos = {}
+        self._vecs = None
+        if self._keys_path.exists() and self._vecs_path.exists():
+            keys = np.load(self._keys_path)
+            vecs = np.load(self._vecs_path, mmap_mode="r")
+            if len(keys) == len(vecs):
+                self._pos = {k: i for i, k in enumerate(keys.tolist())}
+                self._vecs = vecs
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, keys):
+        self._ensure_loaded()
+        found = {}
+        miss = []
+        for i, k in enumerate(keys):
+            j = self._pos.get(k)
+            if j is None:
+                miss.append(i)
+            else:
+                found[i] = j
+        self.hits += len(found)
+        self.misses += len(miss)
+        return found, miss
+
+    def vectors(self, rows):
+        return np.asarray(self._vecs[np.asarray(rows, dtype=np.int64)], dtype=np.float32)
+
+    def add(self, keys, vecs):
+        # misses are spooled to disk, not kept until save(): the cache must not hold the corpus in RAM
+        vecs = np.ascontiguousarray(vecs, dtype=self.dtype)
+        if self._new_f is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._new_f = self._new_path.open("wb")
+            self._new_dim = vecs.shape[1]
+        self._new_f.write(vecs.tobytes())
+        self._new_keys.extend(keys)
+
+    def _new_vectors(self):
+        if self._new_f is None:
+            return None
+        self._new_f.close()
+        if not self._new_keys:
+            return None
+        return np.memmap(self._new_path, dtype=self.dtype, mode="r", shape=(len(self._new_keys), self._new_dim))
+
+    def save(self, live_keys, batch=65536):
+        self._ensure_loaded()
+        live = set(live_keys)
+        keys = []
+        sources = []
+
+        old_rows = [j for k, j in self._pos.items() if k in live]
+        if old_rows:
+            old_rows.sort()
+            inv = {j: k for k, j in self._pos.items()}
+            keys.extend(inv[j] for j in old_rows)
+            sources.append((self._vecs, old_rows))
+
+        new_vecs = self._new_vectors()
+        if new_vecs is not None:
+            seen = set(keys)
+            take = []
+            for i, k in enumerate(self._new_keys):
+                if k in live and k not in seen:
+                    seen.add(k)
+                    take.append(i)
+                    keys.append(k)
+            if take:
+                sources.append((new_vecs, take))
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if sources:
+            dim = sources[0][0].shape[1]
+            tmp = self._vecs_path.with_name(self._vecs_path.name + ".tmp")
+            out = np.lib.format.open_memmap(tmp, mode="w+", dtype=self.dtype, shape=(len(keys), dim))
+            at = 0
+            for src, rows in sources:
+                for i in range(0, len(rows), batch):
+                    part = np.asarray(rows[i:i + batch], dtype=np.int64)
+                    out[at:at + len(part)] = src[part]
+                    at += len(part)
+            out.flush()
+            del out
+            self._vecs = None
+            os.replace(tmp, self._vecs_path)
+            _save_npy(self._keys_path, np.asarray(keys, dtype="S32"))
+        else:
+            self._vecs = None
+            self._keys_path.unlink(missing_ok=True)
+            self._vecs_path.unlink(missing_ok=True)
+
+        self._pos = None
+        self.discard()
+        return len(keys)
+
+    def discard(self):
+        if self._new_f is not None:
+            self._new_f.close()
+            self._new_path.unlink(missing_ok=True)
+        self._new_f = None
+        self._new_dim = None
+        self._new_keys = []
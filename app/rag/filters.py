@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import PurePosixPath
+
+import numpy as np
+
+def _tuple(v):
+    if v is None:
+        return ()
+    if isinstance(v, str):
+        v = v.split(",")
+    return tuple(s.strip() for s in v if s and s.strip())
+
+def _timestamp(v):
+    if v is None or v == "":
+        return None
+    if isinstance(v, datetime):
+        return v.timestamp()
+    if isinstance(v, (int, float)):
+        return float(v)
+    return datetime.fromisoformat(str(v).strip()).timestamp()
+
+@dataclass(frozen=True)
+class SearchFilter:
+    sources: tuple = ()
+    doc_id_prefixes: tuple = ()
+    file_types: tuple = ()
+    uploaded_after: float | None = None
+    uploaded_before: float | None = None
+
+    @classmethod
+    def build(cls, source=None, doc_id_prefix=None, file_type=None, uploaded_after=None, uploaded_before=None):
+        f = cls(sources=_tuple(source),
+            doc_id_prefixes=_tuple(doc_id_prefix),
+            file_types=tuple(t.lower().lstrip(".") for t in _tuple(file_type)),
+            uploaded_after=_timestamp(uploaded_after),
+            uploaded_before=_timestamp(uploaded_before))
+        return f if f else None
+
+    def __bool__(self):
+        return bool(self.sources or self.doc_id_prefixes or self.file_types) \
+            or self.uploaded_after is not None or self.uploaded_before is not None
+
+    def key(self):
+        return repr((sorted(self.sources), sorted(self.doc_id_prefixes), sorted(self.file_types),
+            self.uploaded_after, self.uploaded_before))
+
+class DocFilterIndex:
+    def __init__(self, index_file, files, cache_size=64):
+        self.docs = np.array(index_file.dict_values("doc_id") if index_file.n_chunks else [], dtype=object)
+        codes = np.asarray(index_file.codes("doc_id")) if index_file.n_chunks else np.zeros(0, dtype=np.int32)
+        self.n_chunks = len(codes)
+        self.order = np.argsort(codes, kind="stable")
+        self.ptr = np.zeros(len(self.docs) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(self.docs)), out=self.ptr[1:])
+        self.basenames = np.array([PurePosixPath(d).name for d in self.docs], dtype=object)
+        self.types = np.array([PurePosixPath(d).suffix.lower().lstrip(".") for d in self.docs], dtype=object)
+        self.mtimes = np.array([float((files.get(d) or {}).get("mtime", np.nan)) for d in self.docs])
+        self.cache_size = cache_size
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _doc_select(self, f: SearchFilter):
+        names = self.docs
+        sel = np.ones(len(self.docs), dtype=bool)
+        if f.sources:
+            wanted = set(f.sources)
+            sel &= np.fromiter((d in wanted or b in wanted for d, b in zip(names, self.basenames)),
+                dtype=bool, count=len(names))
+        if f.doc_id_prefixes:
+            sel &= np.fromiter((d.startswith(f.doc_id_prefixes) for d in names), dtype=bool, count=len(names))
+        if f.file_types:
+            sel &= np.isin(self.types, list(f.file_types))
+        with np.errstate(invalid="ignore"):
+            if f.uploaded_after is not None:
+                sel &= self.mtimes >= f.uploaded_after
+            if f.uploaded_before is not None:
+                sel &= self.mtimes < f.uploaded_before
+        return np.flatnonzero(sel)
+
+    def mask(self, f: SearchFilter):
+        key = f.key()
+        with self._lock:
+            m = self._masks.get(key)
+            if m is not None:
+                self._masks.move_to_end(key)
+                return m
+
+        docs = self._doc_select(f)
+        m = np.zeros(self.n_chunks, dtype=bool)
+        if len(docs):
+            rows = np.concatenate([self.order[self.ptr[d]:self.ptr[d + 1]] for d in docs])
+            m[rows] = True
+        m.flags.writeable = False
+
+        with self._lock:
+            self._masks[key] = m
+            while len(self._masks) > self.cache_size:
+                self._masks.popitem(last=False)
+        return m
@@ -0,0 +1,97 @@
+import itertools
+import multiprocessing as mp
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import numpy as np
+
+from .chunking import iter_doc_chunks, load_doc_chunks
+
+def default_workers():
+    return max(1, min(4, (os.cpu_count() or 2) - 1))
+
+INLINE_BYTES = 16 << 20
+
+def _size(p: Path):
+    try:
+        return p.stat().st_size
+    except OSError:
+        return 0
+
+def parse_docs(paths, kb_dir: Path, max_chars, overlap, workers=1, window=None, inline_bytes=INLINE_BYTES,
+        failed=None):
+    failed = failed if failed is not None else []
+    if workers <= 1 or len(paths) <= 1:
+        for p in paths:
+            yield p, iter_doc_chunks(p, kb_dir, max_chars, overlap, failed)
+        return
+
+    # large files are chunked lazily in this process: a worker would pickle all their chunks back at once
+    window = window or 2 * workers
+    it = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as ex:
+        def submit(p):
+            if inline_bytes and _size(p) > inline_bytes:
+                return None
+            try:
+                return ex.submit(load_doc_chunks, p, kb_dir, max_chars, overlap)
+            except BrokenProcessPool:
+                return None
+
+        pending = deque((p, submit(p)) for p in itertools.islice(it, window))
+        while pending:
+            p, fut = pending.popleft()
+            chunks = None
+            if fut is not None:
+                try:
+                    chunks, bad = fut.result()
+                    if bad:
+                        failed.append(p)
+                except BrokenProcessPool:
+                    # a worker died (e.g. OOM on a large PDF): the pool is unusable, the rest is parsed here
+                    pass
+                except Exception:
+                    failed.append(p)
+                    chunks = []
+            if chunks is None:
+                chunks = iter_doc_chunks(p, kb_dir, max_chars, overlap, failed)
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, submit(nxt)))
+            yield p, chunks
+
+def batched(items, n):
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+class EmbeddingSpool:
+    def __init__(self, path: Path):
+        self.path = path
+        self.rows = 0
+        self.dim = None
+        self._f = path.open("wb")
+
+    def append(self, emb):
+        emb = np.ascontiguousarray(emb, dtype=np.float32)
+        if self.dim is None:
+            self.dim = emb.shape[1]
+        self._f.write(emb.tobytes())
+        self.rows += len(emb)
+
+    def array(self):
+        self._f.close()
+        if not self.rows:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode="r", shape=(self.rows, self.dim))
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+        self.path.unlink(missing_ok=True)
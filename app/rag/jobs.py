@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+class ReindexJobs:
+    def __init__(self, rag, history=50, redis=None, namespace="kbjobs", ttl_seconds=86400, collection="default"):
+        self.rag = rag
+        self.collection = collection
+        self.history = history
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self._jobs = OrderedDict()
+        self._queued = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _publish(self, job):
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(f"{self.namespace}:{job['job_id']}", json.dumps(job), ex=self.ttl_seconds)
+        except Exception:
+            pass
+
+    def submit(self, incremental=False):
+        with self._lock:
+            job = self._queued
+            if job is not None:
+                job["incremental"] = job["incremental"] and incremental
+                job["coalesced"] += 1
+            else:
+                job = {"job_id": uuid.uuid4().hex, "collection": self.collection,
+                    "status": "queued", "incremental": incremental,
+                    "coalesced": 0, "stage": "", "done": 0, "total": None,
+                    "created_at": time.time(), "started_at": None, "finished_at": None,
+                    "result": None, "error": None}
+                self._jobs[job["job_id"]] = job
+                while len(self._jobs) > self.history:
+                    oldest = next(iter(self._jobs.values()))
+                    if oldest["status"] in ("queued", "running"):
+                        break
+                    self._jobs.popitem(last=False)
+                self._queued = job
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="kb-reindex", daemon=True)
+                    self._thread.start()
+            out = dict(job)
+        self._publish(out)
+        return out
+
+    def get(self, job_id, remote=True):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        if self.redis is None or not remote:
+            return None
+        try:
+            raw = self.redis.get(f"{self.namespace}:{job_id}")
+        except Exception:
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    def active(self):
+        with self._lock:
+            return [dict(j) for j in self._jobs.values() if j["status"] in ("queued", "running")]
+
+    def _progress(self, job, stage, done, total=None):
+        with self._lock:
+            job["stage"], job["done"], job["total"] = stage, done, total
+            out = dict(job)
+        self._publish(out)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                job = self._queued
+                if job is None:
+                    self._thread = None
+                    return
+                self._queued = None
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                out = dict(job)
+            self._publish(out)
+
+            try:
+                out = self.rag.reindex(incremental=job["incremental"],
+                    progress=lambda stage, done, total=None: self._progress(job, stage, done, total))
+                status, result, error = "done", out, None
+            except Exception as e:
+                status, result, error = "failed", None, str(e)
+
+            with self._lock:
+                job["status"], job["result"], job["error"] = status, result, error
+                job["finished_at"] = time.time()
+                out = dict(job)
+            self._publish(out)
@@ -1,62 +1,84 @@
 from dataclasses import dataclass
 from pathlib import Path
 import csv
+import hashlib
 
 from pypdf import PdfReader
 from docx import Document as DocxDocument
 
 @dataclass
-class Doc:
-    doc_id: str
-    source: str
+class Segment:
     text: str
+    title: str | None = None
+    page: int | None = None
+    row_start: int | None = None
+    row_end: int | None = None
 
 def load_md_txt(path: Path):
     return path.read_text(encoding="utf-8", errors="ignore")
 
-def load_pdf(path: Path):
+def iter_pdf_pages(path: Path):
     r = PdfReader(str(path))
-    parts = []
-    for p in r.pages:
-        parts.append(p.extract_text() or "")
-    return "\n".join(parts)
+    for i, p in enumerate(r.pages):
+        yield Segment(text=p.extract_text() or "", page=i + 1)
 
 def load_docx(path: Path):
     d = DocxDocument(str(path))
     return "\n".join(p.text for p in d.paragraphs)
 
-def load_csv(path: Path, max_rows=2000):
-    rows = []
+def iter_csv_blocks(path: Path, max_chars=4000):
     with path.open("r", encoding="utf-8", errors="ignore", newline="") as f:
         reader = csv.reader(f)
-        for i, row in enumerate(reader):
-            rows.append(" | ".join(row))
-            if i >= max_rows:
-                break
-    return "\n".join(rows)
-
-def load_docs_from_dir(kb_dir: Path):
-    exts = {".md", ".txt", ".pdf", ".docx", ".csv"}
-    docs = []
+        header = next(reader, None)
+        if header is None:
+            return
+        header = " | ".join(header)[:max(1, max_chars // 2)]
+        room = max(1, max_chars - len(header) - 1)
+        rows, size, start = [], len(header), 1
+        for i, row in enumerate(reader, start=1):
+            line = " | ".join(row)
+            if rows and size + 1 + len(line) > max_chars:
+                yield Segment(text=header + "\n" + "\n".join(rows), row_start=start, row_end=i - 1)
+                rows, size, start = [], len(header), i
+            if len(line) > room:
+                for j in range(0, len(line), room):
+                    yield Segment(text=header + "\n" + line[j:j + room], row_start=i, row_end=i)
+                start = i + 1
+                continue
+            rows.append(line)
+            size += 1 + len(line)
+        if rows:
+            yield Segment(text=header + "\n" + "\n".join(rows), row_start=start, row_end=start + len(rows) - 1)
+        elif start == 1:
+            yield Segment(text=header)
+
+KB_EXTS = {".md", ".txt", ".pdf", ".docx", ".csv"}
+
+def list_kb_files(kb_dir: Path):
+    out = []
     for p in sorted(kb_dir.rglob("*")):
         if not p.is_file():
             continue
-        if p.suffix.lower() not in exts:
+        if p.suffix.lower() not in KB_EXTS:
             continue
-        rel = p.relative_to(kb_dir).as_posix()
-        try:
-            suf = p.suffix.lower()
-            if suf in {".md", ".txt"}:
-                text = load_md_txt(p)
-            elif suf == ".pdf":
-                text = load_pdf(p)
-            elif suf == ".docx":
-                text = load_docx(p)
-            elif suf == ".csv":
-                text = load_csv(p)
-            else:
-                continue
-            docs.append(Doc(doc_id=rel, source=rel, text=text))
-        except Exception:
-            continue
-    return docs
+        out.append(p)
+    return out
+
+def file_fingerprint(path: Path):
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    st = path.stat()
+    return {"sha256": h.hexdigest(), "mtime": st.st_mtime, "size": st.st_size}
+
+def iter_segments(path: Path, max_chars=4000):
+    suf = path.suffix.lower()
+    if suf in {".md", ".txt"}:
+        yield Segment(text=load_md_txt(path))
+    elif suf == ".pdf":
+        yield from iter_pdf_pages(path)
+    elif suf == ".docx":
+        yield Segment(text=load_docx(path))
+    elif suf == ".csv":
+        yield from iter_csv_blocks(path, max_chars)
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class RetrievalBusy(RuntimeError):
+    pass
+
+class RetrievalPool:
+    def __init__(self, workers=4, max_queue=64, timeout_s=30.0):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout_s = timeout_s
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="kb-retrieval")
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "rejected": 0, "timeouts": 0, "errors": 0}
+
+    def _release(self, _fut):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self.stats["rejected"] += 1
+                raise RetrievalBusy(f"KB retrieval queue is full ({self._pending} pending)")
+            self._pending += 1
+            self.stats["calls"] += 1
+        fut = self._pool.submit(fn, *args, **kwargs)
+        fut.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(fut), self.timeout_s or None)
+        except asyncio.TimeoutError:
+            fut.cancel()
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise
+        except Exception:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+            out["pending"] = self._pending
+        out["workers"] = self.workers
+        out["max_queue"] = self.max_queue
+        return out
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,67 +1,131 @@
 import re
-from dataclasses import dataclass
+import threading
+import uuid
+from collections.abc import Sequence
+from functools import partial
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import numpy as np
-import faiss
-from rank_bm25 import BM25Okapi
-from sentence_transformers import SentenceTransformer, CrossEncoder
 
-from .loaders import load_docs_from_dir
-from .store import (save_chunks, load_chunks,
-    save_bm25_tokens, load_bm25_tokens,
-    save_faiss, load_faiss)
-
-@dataclass
-class Chunk:
-    doc_id: str
-    source: str
-    chunk_id: str
-    title: str
-    text: str
-
-_heading_re = re.compile(r"^(#{1,6})\s+(.*)$", re.MULTILINE)
-
-def _split_md_by_headings(text):
-    matches = list(_heading_re.finditer(text))
-    if not matches:
-        return [("Document", text.strip())]
-    out = []
-    for i, m in enumerate(matches):
-        start = m.start()
-        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
-        title = (m.group(2) or "").strip() or "Section"
-        body = text[start:end].strip()
-        out.append((title, body))
-    return out
-
-def _chunk_text(title, body, max_chars, overlap):
-    body = re.sub(r"\s+", " ", body).strip()
-    if not body:
-        return []
-    chunks = []
-    i = 0
-    n = len(body)
-    while i < n:
-        j = min(i + max_chars, n)
-        piece = body[i:j].strip()
-        if piece:
-            chunks.append((title, piece))
-        if j == n:
-            break
-        i = max(0, j - overlap)
-    return chunks
+from .ann import (AnnParams, build_index, can_remove, choose_kind, filtered_search, mmap_flags,
+    rescore, set_search_params, storage_key)
+from .backends import ModelCache, load_model, model_id
+from .batcher import EmbeddingBatcher
+from .bm25 import SparseBM25
+from .cache import QueryCache
+from .chunking import Chunk
+from .rerank import RerankStage
+from .emb_cache import EmbeddingCache, text_key
+from .filters import DocFilterIndex
+from .ingest import EmbeddingSpool, batched, default_workers, parse_docs
+from .loaders import list_kb_files, file_fingerprint
+from .store import (CURRENT_FILE, INDEX_FILE, ChunkSpool, ChunkTable, save_index, load_index,
+    load_chunks, load_bm25_tokens, remove_legacy_json,
+    save_faiss, load_faiss,
+    save_manifest, load_manifest,
+    current_dir, generation_marker, new_generation_dir, publish_generation, prune_generations,
+    VocabLookup, build_lock)
+
+_EXACT_FILTER_ROWS = 4096
 
 def _tokenize(text):
     return re.findall(r"[a-zA-Zа-яА-Я0-9_]+", text.lower())
 
-def _normalize_scores(scores):
-    if not scores:
-        return []
-    mn, mx = min(scores), max(scores)
-    if abs(mx - mn) < 1e-9:
-        return [0.0 for _ in scores]
-    return [(s - mn) / (mx - mn) for s in scores]
+def _no_progress(stage, done, total=None):
+    pass
+
+def _encode_with(model, texts):
+    emb = model.encode(texts, normalize_embeddings=True, show_progress_bar=False)
+    return np.asarray(emb, dtype=np.float32)
+
+def _token_ids(texts, vocab):
+    return [[vocab.setdefault(t, len(vocab)) for t in _tokenize(x)] for x in texts]
+
+def _provenance(c):
+    out = {}
+    if c.page is not None:
+        out["page"] = c.page
+    if c.row_start is not None:
+        out["rows"] = [c.row_start, c.row_end]
+    return out
+
+def _ann_out(ann_info):
+    info = ann_info or {}
+    return {"ann_index": info.get("kind", ""), "ann_recall": info.get("recall"),
+        "ann_storage": info.get("storage", ""), "index_bytes": info.get("index_bytes"),
+        "rescore_bytes": info.get("rescore_bytes"), "vector_bytes": info.get("vector_bytes"),
+        "float32_bytes": info.get("float32_bytes")}
+
+def _minmax(x):
+    if not len(x):
+        return x
+    mn, mx = x.min(), x.max()
+    if mx - mn < 1e-9:
+        return np.zeros_like(x)
+    return (x - mn) / (mx - mn)
+
+def _fuse(sem_ids, sem_scores, lex_ids, lex_scores, alpha, top, mode="minmax", rrf_k=60):
+    cand = np.union1d(sem_ids, lex_ids)
+    sem = np.zeros(len(cand), dtype=np.float32)
+    lex = np.zeros(len(cand), dtype=np.float32)
+    if mode == "rrf":
+        sem[np.searchsorted(cand, sem_ids)] = 1.0 / (rrf_k + np.arange(1, len(sem_ids) + 1))
+        lex[np.searchsorted(cand, lex_ids)] = 1.0 / (rrf_k + np.arange(1, len(lex_ids) + 1))
+        score = sem + lex
+    else:
+        sem[np.searchsorted(cand, sem_ids)] = sem_scores
+        lex[np.searchsorted(cand, lex_ids)] = lex_scores
+        sem = _minmax(sem)
+        lex = _minmax(lex)
+        score = alpha * sem + (1 - alpha) * lex
+
+    if top < len(cand):
+        sel = np.argpartition(-score, top - 1)[:top]
+        order = sel[np.argsort(-score[sel], kind="stable")]
+    else:
+        order = np.argsort(-score, kind="stable")
+    return cand[order], score[order], sem[order], lex[order]
+
+@dataclass
+class IndexGeneration:
+    path: Path
+    manifest: dict = field(default_factory=dict)
+    index_file: object = None
+    chunks: Sequence = ()
+    faiss: object = None
+    bm25: SparseBM25 | None = None
+    vocab: object = field(default_factory=dict)
+    vectors: object = None
+    filters: DocFilterIndex | None = None
+
+    @property
+    def generation(self):
+        return int(self.manifest.get("generation", 0))
+
+    @property
+    def build_id(self):
+        return self.manifest.get("build_id", "")
+
+def _open_generation(path, manifest, ix, fx):
+    g = IndexGeneration(path=path, manifest=manifest or {}, index_file=ix, faiss=fx)
+    if ix is None:
+        return g
+    g.chunks = ChunkTable(ix, Chunk)
+    if ix.has("emb.f32") and ix.n_chunks:
+        g.vectors = ix.array("emb.f32").reshape(ix.n_chunks, -1)
+    g.vocab = VocabLookup(ix) if ix.has("vocab.order") else {t: i for i, t in enumerate(ix.vocab())}
+    if not ix.n_chunks:
+        g.bm25 = None
+    elif ix.has("bm25.ptr"):
+        g.bm25 = SparseBM25(ix.array("bm25.ptr"), ix.array("bm25.docs"),
+            ix.array("bm25.tf"), ix.array("bm25.doc_len"))
+    else:
+        g.bm25 = SparseBM25.from_token_ids(ix.array("tokens.ids"),
+            ix.array("tokens.offsets"), len(g.vocab))
+    return g
+
+_UNSET = object()
 
 class HybridRAG:
     def __init__(
@@ -76,6 +140,25 @@ class HybridRAG:
         use_rerank: bool,
         rerank_model: str,
         rerank_topn: int,
+        rerank_batch_size: int = 32,
+        rerank_budget_ms: int = 0,
+        rerank_skip_margin: float = 0.0,
+        rerank_cache_size: int = 20000,
+        fusion: str = "minmax",
+        rrf_k: int = 60,
+        emb_cache: bool = True,
+        emb_cache_dtype: str = "float16",
+        ann: AnnParams | None = None,
+        query_cache: QueryCache | None = None,
+        ingest_workers: int = 0,
+        embed_batch_size: int = 256,
+        query_batch_window_ms: float = 0,
+        query_batch_max: int = 64,
+        model_backend: str = "torch",
+        onnx_quant_config: str = "avx2",
+        onnx_min_parity: float = 0.98,
+        model_cache: ModelCache | None = None,
+        model_dir: Path | None = None,
     ):
         self.kb_dir = kb_dir
         self.index_dir = index_dir
@@ -87,154 +170,610 @@ class HybridRAG:
         self.use_rerank = use_rerank
         self.rerank_model = rerank_model
         self.rerank_topn = rerank_topn
+        self._rerank_stage = RerankStage(self._ensure_reranker, rerank_topn,
+            batch_size=rerank_batch_size,
+            budget_ms=rerank_budget_ms,
+            skip_margin=rerank_skip_margin,
+            cache_size=rerank_cache_size)
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.ann = ann or AnnParams()
+        self._query_cache = query_cache
+        self.ingest_workers = ingest_workers or default_workers()
+        self.embed_batch_size = embed_batch_size
+        self.emb_cache = emb_cache
+        self.emb_cache_dtype = emb_cache_dtype
+        self.model_backend = model_backend
+        self.onnx_quant_config = onnx_quant_config
+        self.onnx_min_parity = onnx_min_parity
+        self.model_dir = model_dir or index_dir / "models"
+        self._model_cache = model_cache
+        self._emb_cache = None
+        self.query_batch_window_ms = query_batch_window_ms
+        self.query_batch_max = query_batch_max
+        self._query_batcher = None
 
         self._reranker = None
         self._embedder = None
-        self._chunks = []
-        self._faiss = None
-        self._bm25 = None
-        self._bm25_tokens = None
+        self._model_info = {}
+        self._model_lock = threading.Lock()
+        self._gen = IndexGeneration(path=index_dir)
+        self._build_lock = threading.Lock()
+        self._build_owner = None
+        self._marker = _UNSET
+        self._watcher = None
+        self._watch_stop = threading.Event()
+
+    def _load_model(self, kind, name):
+        def _load():
+            chunks = self._gen.chunks
+            return load_model(kind, name, self.model_backend,
+                cache_dir=self.model_dir,
+                quant_config=self.onnx_quant_config,
+                min_parity=self.onnx_min_parity,
+                parity_texts=[chunks[i].text for i in range(min(32, len(chunks)))] or None)
+
+        if self._model_cache is None:
+            model, info = _load()
+        else:
+            model, info = self._model_cache.get((kind, name, self.model_backend, self.onnx_quant_config), _load)
+        self._model_info[kind] = info
+        return model
 
     def _ensure_embedder(self):
         if self._embedder is None:
-            self._embedder = SentenceTransformer(self.emb_model)
+            with self._model_lock:
+                if self._embedder is None:
+                    self._embedder = self._load_model("embedder", self.emb_model)
         return self._embedder
-    
+
     def _ensure_reranker(self):
         if self._reranker is None:
-            self._reranker = CrossEncoder(self.rerank_model)
+            with self._model_lock:
+                if self._reranker is None:
+                    self._reranker = self._load_model("reranker", self.rerank_model)
         return self._reranker
 
-    def load_if_exists(self):
+    def _ensure_batcher(self):
+        if self._query_batcher is None:
+            model = self._ensure_embedder()
+            make = lambda: EmbeddingBatcher(partial(_encode_with, model), self.query_batch_window_ms,
+                self.query_batch_max)
+            with self._model_lock:
+                if self._query_batcher is None:
+                    # one batcher per model, so micro-batches span every collection using it
+                    self._query_batcher = make() if self._model_cache is None else self._model_cache.get(
+                        ("batcher", self.emb_model, self.model_backend, self.onnx_quant_config), make)
+        return self._query_batcher
+
+    def _embedding_id(self):
+        if self.model_backend == "torch":
+            return self.emb_model
+        self._ensure_embedder()
+        return model_id(self.emb_model, self._model_info["embedder"]["backend"], self.onnx_quant_config)
+
+    def _ensure_emb_cache(self):
+        if self._emb_cache is None and self.emb_cache:
+            self._emb_cache = EmbeddingCache(self.index_dir / "emb_cache", self._embedding_id(), self.emb_cache_dtype)
+        return self._emb_cache
+
+    def model_stats(self):
+        return dict(self._model_info)
+
+    def _migrate_legacy_json(self):
+        if not (self.index_dir / "chunks.json").exists():
+            return False
+        if self._build_owner == threading.get_ident():
+            return self._migrate_locked()
+        with build_lock(self.index_dir):
+            return self._migrate_locked()
+
+    def _migrate_locked(self):
+        # another worker may have migrated or published a generation while we waited for the lock
+        if (self.index_dir / CURRENT_FILE).exists() or (self.index_dir / INDEX_FILE).exists():
+            return True
         meta = load_chunks(self.index_dir)
         toks = load_bm25_tokens(self.index_dir)
-        fx = load_faiss(self.index_dir)
-
-        if not meta or toks is None:
+        if meta is None or toks is None:
             return False
-
-        self._chunks = [Chunk(**m) for m in meta]
-        self._bm25_tokens = toks
-        self._bm25 = BM25Okapi(self._bm25_tokens)
-        self._faiss = fx
+        vocab = {}
+        ids = [[vocab.setdefault(t, len(vocab)) for t in tt] for tt in toks]
+        spool = ChunkSpool(self.index_dir / "ingest.chunks.tmp")
+        try:
+            spool.append([Chunk(**m) for m in meta], ids)
+            save_index(self.index_dir, spool, list(vocab))
+        finally:
+            spool.close()
+        remove_legacy_json(self.index_dir)
         return True
 
-    def reindex(self):
-        docs = load_docs_from_dir(self.kb_dir)
-
-        chunks = []
-        for d in docs:
-            local_i = 0
-            sections = _split_md_by_headings(d.text)
-            for title, sec in sections:
-                for title2, piece in _chunk_text(title, sec, self.chunk_max_chars, self.chunk_overlap_chars):
-                    cid = f"{d.doc_id}::c{local_i:04d}"
-                    local_i += 1
-                    chunks.append(Chunk(
-                        doc_id=d.doc_id,
-                        source=d.source,
-                        chunk_id=cid,
-                        title=title2,
-                        text=piece,
-                    ))
-
-        self._chunks = chunks
-        texts = [c.text for c in chunks]
-
-        if not texts:
-            save_chunks(self.index_dir, [])
-            save_bm25_tokens(self.index_dir, [])
-            self._faiss = None
-            self._bm25 = BM25Okapi([[]])
-            self._bm25_tokens = [[]]
-            return {"docs": 0, "chunks": 0}
-
-        emb = self._ensure_embedder().encode(texts, normalize_embeddings=True, show_progress_bar=False)
-        emb = np.asarray(emb, dtype=np.float32)
-
-        dim = emb.shape[1]
-        index = faiss.IndexFlatIP(dim)
-        index.add(emb)
-        self._faiss = index
-
-        bm25_tokens = [_tokenize(t) for t in texts]
-        self._bm25_tokens = bm25_tokens
-        self._bm25 = BM25Okapi(bm25_tokens)
-
-        save_chunks(self.index_dir, [c.__dict__ for c in chunks])
-        save_bm25_tokens(self.index_dir, bm25_tokens)
-        save_faiss(self.index_dir, index)
-
-        return {"docs": len({c.doc_id for c in chunks}), "chunks": len(chunks)}
-
-    def search(self, query, k=5):
-        if not self._chunks:
-            self.load_if_exists()
-
-        if not self._chunks or (self._faiss is None and self._bm25 is None):
-            return []
+    def _load_faiss(self, path, ann_info):
+        kind = (ann_info or {}).get("kind", "flat")
+        fx = load_faiss(path, mmap_flags(kind) if self.ann.mmap else 0)
+        if fx is not None:
+            info = ann_info or {}
+            set_search_params(fx, max(self.ann.nprobe, info.get("nprobe", 0)),
+                max(self.ann.ef_search, info.get("ef_search", 0)))
+        return fx
 
-        sem_ids = []
-        sem_scores = []
-        if self._faiss is not None:
-            qemb = self._ensure_embedder().encode([query], normalize_embeddings=True, show_progress_bar=False)
-            qemb = np.asarray(qemb, dtype=np.float32)
-            D, I = self._faiss.search(qemb, min(self.candidates, len(self._chunks)))
-            sem_ids = I[0].tolist()
-            sem_scores = D[0].tolist()
-
-        lex_ids = []
-        lex_scores = []
-        if self._bm25 is not None and self._bm25_tokens is not None:
-            qtoks = _tokenize(query)
-            scores = self._bm25.get_scores(qtoks)
-            top = np.argsort(scores)[::-1][: min(self.candidates, len(self._chunks))]
-            lex_ids = top.tolist()
-            lex_scores = [float(scores[i]) for i in lex_ids]
-
-        cand_set = set(sem_ids) | set(lex_ids)
-        if not cand_set:
-            return []
+    def load_if_exists(self):
+        self._marker = generation_marker(self.index_dir)
+        path = current_dir(self.index_dir)
+        ix = load_index(path)
+        if ix is None and path == self.index_dir and self._migrate_legacy_json():
+            path = current_dir(self.index_dir)
+            ix = load_index(path)
+        if ix is None:
+            return False
+        manifest = load_manifest(path) or {}
+        fx = self._load_faiss(path, manifest.get("ann")) if ix.n_chunks else None
+        self._gen = _open_generation(path, manifest, ix, fx)
+        return ix.n_chunks > 0
+
+    def refresh(self):
+        if generation_marker(self.index_dir) == self._marker:
+            return False
+        if current_dir(self.index_dir) == self._gen.path and self._gen.index_file is not None:
+            self._marker = generation_marker(self.index_dir)
+            return False
+        self.load_if_exists()
+        return True
 
-        sem_map = {i: s for i, s in zip(sem_ids, sem_scores)}
-        lex_map = {i: s for i, s in zip(lex_ids, lex_scores)}
-
-        sem_pool = [sem_map.get(i, 0.0) for i in cand_set]
-        lex_pool = [lex_map.get(i, 0.0) for i in cand_set]
-        sem_norm = _normalize_scores(sem_pool)
-        lex_norm = _normalize_scores(lex_pool)
-
-        cand_list = list(cand_set)
-        hits = []
-        for idx, i in enumerate(cand_list):
-            s_sem = sem_norm[idx]
-            s_lex = lex_norm[idx]
-            score = self.hybrid_alpha * s_sem + (1 - self.hybrid_alpha) * s_lex
-            c = self._chunks[i]
-            hits.append({
-                "source": c.source,
-                "doc_id": c.doc_id,
-                "chunk_id": c.chunk_id,
-                "title": c.title,
-                "text": c.text,
-                "score": float(score),
-                "score_sem": float(s_sem),
-                "score_lex": float(s_lex),
-            })
-
-        hits.sort(key=lambda x: x["score"], reverse=True)
-
-        if self.use_rerank and hits:
-            topn = min(max(1, self.rerank_topn), len(hits))
-            subset = hits[:topn]
+    def watch(self, interval_s):
+        if self._watcher is not None or interval_s <= 0:
+            return
+
+        def _loop():
+            while not self._watch_stop.wait(interval_s):
+                try:
+                    self.refresh()
+                except Exception:
+                    pass
+
+        self._watcher = threading.Thread(target=_loop, name="kb-index-watch", daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._watch_stop.set()
+
+    def memory_bytes(self):
+        g = self._gen
+        if g.index_file is None:
+            return 0
+        total = 0
+        for name in (INDEX_FILE, "faiss.index"):
             try:
-                pairs = [[query, h["text"]] for h in subset]
-                r_scores = self._ensure_reranker().predict(pairs)
-                for i, s in enumerate(r_scores):
-                    subset[i]["rerank_score"] = float(s)
-                subset.sort(key=lambda x: x.get("rerank_score", -1e9), reverse=True)
-                hits = subset + hits[topn:]
-            except Exception:
+                total += (g.path / name).stat().st_size
+            except FileNotFoundError:
                 pass
-        return hits[:k]
-
+        return total
+
+    def close(self):
+        self.stop_watching()
+        if self._query_batcher is not None and self._model_cache is None:
+            self._query_batcher.close()
+        self._gen = IndexGeneration(path=self.index_dir)
+        self._marker = _UNSET
+
+    def status(self):
+        g = self._gen
+        return {"generation": g.generation, "build_id": g.build_id,
+            "path": str(g.path), "chunks": len(g.chunks),
+            "index_loaded": g.index_file is not None,
+            "embedder_warm": self._embedder is not None,
+            "reranker_warm": self._reranker is not None if self.use_rerank else None}
+
+    def warm_up(self):
+        self._encode(["warmup"])
+        if self.use_rerank:
+            self._ensure_reranker().predict([["warmup", "warmup"]], show_progress_bar=False)
+
+    def _index_params(self):
+        return {"emb_model": self._embedding_id(),
+            "chunk_max_chars": self.chunk_max_chars,
+            "chunk_overlap_chars": self.chunk_overlap_chars,
+            "chunker": 2}
+
+    def _encode(self, texts):
+        return _encode_with(self._ensure_embedder(), texts)
+
+    def _embed(self, texts):
+        cache = self._ensure_emb_cache()
+        if cache is None:
+            return self._encode(texts)
+
+        keys = [text_key(t) for t in texts]
+        found, miss = cache.lookup(keys)
+        uniq = {}
+        for i in miss:
+            uniq.setdefault(keys[i], i)
+        fresh = self._encode([texts[i] for i in uniq.values()]) if uniq else None
+        dim = fresh.shape[1] if fresh is not None else cache.vectors([next(iter(found.values()))]).shape[1]
+
+        emb = np.empty((len(texts), dim), dtype=np.float32)
+        if found:
+            rows = list(found)
+            emb[rows] = cache.vectors([found[i] for i in rows])
+        if uniq:
+            slot = {k: j for j, k in enumerate(uniq)}
+            emb[miss] = fresh[[slot[keys[i]] for i in miss]]
+            cache.add(list(uniq), fresh)
+        return emb
+
+    def _cache_stats(self):
+        cache = self._emb_cache
+        if cache is None:
+            return {"emb_cache_hits": 0, "emb_cache_misses": 0}
+        return {"emb_cache_hits": cache.hits, "emb_cache_misses": cache.misses}
+
+    def _ingest(self, paths, progress, chunks, vocab, failed):
+        spool = EmbeddingSpool(self.index_dir / "ingest.emb.tmp")
+        n = 0
+
+        def _doc_stream():
+            docs = parse_docs(paths, self.kb_dir, self.chunk_max_chars, self.chunk_overlap_chars, self.ingest_workers,
+                failed=failed)
+            for i, (_, doc_chunks) in enumerate(docs):
+                yield from doc_chunks
+                progress("parse", i + 1, len(paths))
+
+        try:
+            for batch in batched(_doc_stream(), self.embed_batch_size):
+                texts = [c.text for c in batch]
+                chunks.append(batch, _token_ids(texts, vocab))
+                n += len(batch)
+                progress("chunk", n)
+                spool.append(self._embed(texts))
+                progress("embed", n)
+        except BaseException:
+            spool.close()
+            raise
+        return spool
+
+    def _commit(self, chunks, vocab, bm25, index, files, ann_info, vectors=None):
+        prev = load_manifest(current_dir(self.index_dir)) or {}
+        generation = int(prev.get("generation", 0)) + 1
+        build_id = uuid.uuid4().hex
+        path = new_generation_dir(self.index_dir, generation, build_id)
+        extra = bm25.arrays() if bm25 is not None else {}
+        rescore_bytes = 0
+        if vectors is not None and ann_info.get("rescore", 1) > 1:
+            extra["emb.f32"] = vectors.reshape(-1)
+            rescore_bytes = int(extra["emb.f32"].nbytes)
+        save_index(path, chunks, vocab, extra)
+        if index is not None:
+            save_faiss(path, index)
+            ann_info["index_bytes"] = (path / "faiss.index").stat().st_size
+            ann_info["rescore_bytes"] = rescore_bytes
+            ann_info["vector_bytes"] = ann_info["index_bytes"] + rescore_bytes
+            ann_info["float32_bytes"] = index.ntotal * index.d * 4
+        manifest = self._manifest(files, ann_info, generation, build_id)
+        save_manifest(path, manifest)
+        if self._emb_cache is not None:
+            self._emb_cache.save(text_key(t) for t in chunks.texts())
+
+        old = self._gen
+        publish_generation(self.index_dir, path)
+        remove_legacy_json(self.index_dir)
+        self._gen = _open_generation(path, manifest, load_index(path), index)
+        self._marker = generation_marker(self.index_dir)
+        prune_generations(self.index_dir, keep={path.name, old.path.name})
+
+    def _manifest(self, files, ann_info, generation, build_id):
+        return {"params": self._index_params(), "files": files, "ann": ann_info,
+            "generation": generation, "build_id": build_id}
+
+    def _can_patch(self, manifest):
+        if not manifest or manifest.get("params") != self._index_params():
+            return False
+        if (not self._gen.chunks or self._gen.build_id != manifest.get("build_id", "")) \
+                and not self.load_if_exists():
+            return False
+        g = self._gen
+        ntotal = g.faiss.ntotal if g.faiss is not None else 0
+        return ntotal == len(g.chunks)
+
+    def reindex(self, incremental=False, progress=None):
+        progress = progress or _no_progress
+        with self._build_lock, build_lock(self.index_dir):
+            self._build_owner = threading.get_ident()
+            try:
+                out = self._reindex(incremental, progress)
+            finally:
+                self._build_owner = None
+                if self._emb_cache is not None:
+                    self._emb_cache.discard()
+        progress("done", out["chunks"], out["chunks"])
+        return out
+
+    def _reindex(self, incremental, progress):
+        paths = list_kb_files(self.kb_dir)
+        manifest = load_manifest(current_dir(self.index_dir))
+        self._emb_cache = None
+        if self._ensure_emb_cache() is not None:
+            self._emb_cache.reset_stats()
+        if incremental and self._can_patch(manifest):
+            out = self._reindex_incremental(paths, manifest, progress)
+        else:
+            out = self._reindex_full(paths, progress)
+        out.update(self._cache_stats())
+        return out
+
+    def _mark_failed(self, files, failed):
+        # a failed file is retried by every incremental reindex; it stays listed so its removal drops partial chunks
+        for p in failed:
+            rel = p.relative_to(self.kb_dir).as_posix()
+            files[rel] = {**files[rel], "failed": True}
+
+    def _reindex_full(self, paths, progress):
+        files = {p.relative_to(self.kb_dir).as_posix(): file_fingerprint(p) for p in paths}
+        chunks = ChunkSpool(self.index_dir / "ingest.chunks.tmp")
+        spool = None
+        try:
+            vocab = {}
+            failed = []
+            spool = self._ingest(paths, progress, chunks, vocab, failed)
+            self._mark_failed(files, failed)
+            if not chunks.n_chunks:
+                self._commit(chunks, [], None, None, files, None)
+                return {"docs": 0, "chunks": 0, "incremental": False, "docs_changed": len(files), "docs_removed": 0,
+                    "docs_failed": len(failed), **_ann_out(None)}
+
+            progress("index", 0, chunks.n_chunks)
+            emb = spool.array()
+            index, ann_info = build_index(emb, self.ann)
+            bm25 = SparseBM25.from_token_ids(*chunks.tokens(), len(vocab))
+            progress("index", chunks.n_chunks, chunks.n_chunks)
+            self._commit(chunks, list(vocab), bm25, index, files, ann_info, emb)
+            return {"docs": chunks.doc_count(), "chunks": chunks.n_chunks,
+                "incremental": False, "docs_changed": len(files), "docs_removed": 0, "docs_failed": len(failed),
+                **_ann_out(ann_info)}
+        finally:
+            if spool is not None:
+                spool.close()
+            chunks.close()
+
+    def _reindex_incremental(self, paths, manifest, progress):
+        prev_files = manifest["files"]
+        ann_info = manifest.get("ann")
+        files = {}
+        changed = []
+        for p in paths:
+            rel = p.relative_to(self.kb_dir).as_posix()
+            prev = prev_files.get(rel)
+            st = p.stat()
+            if prev and not prev.get("failed") and prev["mtime"] == st.st_mtime and prev["size"] == st.st_size:
+                files[rel] = prev
+                continue
+            fp = file_fingerprint(p)
+            files[rel] = fp
+            if not prev or prev.get("failed") or prev["sha256"] != fp["sha256"]:
+                changed.append(p)
+        removed = set(prev_files) - set(files)
+        stale = {p.relative_to(self.kb_dir).as_posix() for p in changed} | removed
+
+        g = self._gen
+        if not stale:
+            g.manifest = self._manifest(files, ann_info, manifest.get("generation", 0), manifest.get("build_id", ""))
+            save_manifest(g.path, g.manifest)
+            return {"docs": g.chunks.doc_count(), "chunks": len(g.chunks),
+                "incremental": True, "docs_changed": 0, "docs_removed": 0,
+                **_ann_out(ann_info)}
+
+        bm25 = g.bm25
+        drop = g.chunks.doc_mask(stale)
+        if drop.any():
+            bm25 = bm25.without(drop)
+        keep = np.flatnonzero(~drop)
+        vocab = dict(g.vocab.items())
+
+        chunks = ChunkSpool(self.index_dir / "ingest.chunks.tmp")
+        spool = vec_spool = None
+        try:
+            for batch in batched(keep.tolist(), self.embed_batch_size):
+                chunks.append([g.chunks[i] for i in batch], [g.index_file.tokens(i) for i in batch])
+            n_keep = chunks.n_chunks
+            failed = []
+            spool = self._ingest(changed, progress, chunks, vocab, failed)
+            self._mark_failed(files, failed)
+            new_emb = spool.array()
+            n_new = chunks.n_chunks - n_keep
+            if n_new:
+                flat, offsets = chunks.tokens()
+                bm25 = bm25.appended(flat[offsets[n_keep]:], offsets[n_keep:] - offsets[n_keep], len(vocab))
+
+            index = None
+            vectors = None
+            progress("index", 0, chunks.n_chunks)
+            if not chunks.n_chunks:
+                bm25 = None
+                vocab = {}
+                ann_info = None
+            else:
+                index = self._patch_ann(g, ann_info, drop, new_emb, chunks.n_chunks)
+                if index is None or ann_info.get("rescore", 1) > 1:
+                    vec_spool = EmbeddingSpool(self.index_dir / "ingest.vec.tmp")
+                    for batch in batched(keep.tolist(), self.embed_batch_size):
+                        vec_spool.append(self._kept_vectors(g, ann_info, batch))
+                    for i in range(0, n_new, self.embed_batch_size):
+                        vec_spool.append(new_emb[i:i + self.embed_batch_size])
+                    vectors = vec_spool.array()
+                if index is None:
+                    index, ann_info = build_index(vectors, self.ann)
+                else:
+                    ann_info = dict(ann_info)
+            progress("index", chunks.n_chunks, chunks.n_chunks)
+            self._commit(chunks, list(vocab), bm25, index, files, ann_info, vectors)
+            return {"docs": chunks.doc_count(), "chunks": chunks.n_chunks,
+                "incremental": True, "docs_changed": len(changed), "docs_removed": len(removed),
+                "docs_failed": len(failed), **_ann_out(ann_info)}
+        finally:
+            for sp in (spool, vec_spool):
+                if sp is not None:
+                    sp.close()
+            chunks.close()
+
+    def _patch_ann(self, g, ann_info, drop, new_emb, n_total):
+        # HNSW/IVF take appends; only flat codes renumber ids on remove, so other kinds rebuild then
+        if g.faiss is None or not ann_info:
+            return None
+        want = storage_key(choose_kind(n_total, self.ann), self.ann)
+        have = f"{ann_info.get('kind')}/{ann_info.get('storage')}"
+        if want != have and ann_info.get("fallback_from") != want:
+            return None
+        if drop.any() and not can_remove(g.faiss):
+            return None
+        index = load_faiss(g.path)
+        if drop.any():
+            index.remove_ids(np.flatnonzero(drop).astype(np.int64))
+        for i in range(0, len(new_emb), self.embed_batch_size):
+            index.add(np.ascontiguousarray(new_emb[i:i + self.embed_batch_size]))
+        set_search_params(index, ann_info["nprobe"], ann_info["ef_search"])
+        return index
+
+    def _kept_vectors(self, g, ann_info, rows):
+        if g.vectors is not None:
+            return g.vectors[rows]
+        if ann_info and ann_info.get("storage") == "float32":
+            return g.faiss.reconstruct_batch(np.asarray(rows, dtype=np.int64))
+        return self._embed([g.chunks[i].text for i in rows])
+
+    def search(self, query, k=5, filters=None):
+        return self.search_batch([query], k, filters)[0]
+
+    def _filter_mask(self, g, filters):
+        if not filters:
+            return None
+        if g.filters is None:
+            g.filters = DocFilterIndex(g.index_file, g.manifest.get("files") or {})
+        return g.filters.mask(filters)
+
+    def search_batch(self, queries, k=5, filters=None):
+        if self._watcher is None:
+            self.refresh()
+
+        g = self._gen
+        if not g.chunks or (g.faiss is None and g.bm25 is None):
+            return [[] for _ in queries]
+        if not queries:
+            return []
+        mask = self._filter_mask(g, filters)
+        if mask is not None and not mask.any():
+            return [[] for _ in queries]
+
+        cache = self._query_cache
+        if cache is None:
+            return self._search_batch(g, queries, k, mask)[0]
+
+        config = self._search_config() + (f"|{filters.key()}" if mask is not None else "")
+        out = [cache.get_results(q, k, g.build_id, config) for q in queries]
+        todo = [i for i, hits in enumerate(out) if hits is None]
+        if todo:
+            fresh, complete = self._search_batch(g, [queries[i] for i in todo], k, mask)
+            for i, hits, ok in zip(todo, fresh, complete):
+                if ok:
+                    cache.put_results(queries[i], k, g.build_id, hits, config)
+                out[i] = hits
+        return out
+
+    def _search_config(self):
+        return f"{self.candidates}|{self.hybrid_alpha}|{self.fusion}|{self.rrf_k}|{self.use_rerank}|{self.rerank_topn}"
+
+    def _encode_queries(self, queries):
+        if self.query_batch_window_ms <= 0:
+            return self._encode(queries)
+        return self._ensure_batcher().encode(queries)
+
+    def _query_embeddings(self, queries):
+        cache = self._query_cache
+        if cache is None:
+            return self._encode_queries(list(queries))
+
+        emb_id = self._embedding_id()
+        vecs = [cache.get_embedding(emb_id, q) for q in queries]
+        miss = [i for i, v in enumerate(vecs) if v is None]
+        if miss:
+            fresh = self._encode_queries([queries[i] for i in miss])
+            for i, v in zip(miss, fresh):
+                cache.put_embedding(emb_id, queries[i], v)
+                vecs[i] = v
+        return np.stack(vecs).astype(np.float32)
+
+    def embed_queries(self, queries):
+        return self._query_embeddings(list(queries))
+
+    def encode(self, texts):
+        return self._encode(list(texts))
+
+    def cache_stats(self):
+        if self._query_cache is None:
+            return None
+        return self._query_cache.snapshot()
+
+    def _dense_search(self, g, qemb, n, mask, n_rows):
+        if mask is not None and g.vectors is not None and n_rows <= _EXACT_FILTER_ROWS:
+            rows = np.flatnonzero(mask)
+            return rescore(g.vectors, qemb, np.broadcast_to(rows, (len(qemb), len(rows))), n)
+        factor = (g.manifest.get("ann") or {}).get("rescore", 1) if g.vectors is not None else 1
+        kk = min(n_rows, n * factor)
+        sem = g.faiss.search(qemb, kk) if mask is None else filtered_search(g.faiss, qemb, kk, mask)
+        if factor > 1:
+            sem = rescore(g.vectors, qemb, sem[1], n)
+        return sem
+
+    def _search_batch(self, g, queries, k, mask=None):
+        n_rows = int(np.count_nonzero(mask)) if mask is not None else len(g.chunks)
+        n = min(self.candidates, n_rows)
+        sem = None
+        if g.faiss is not None:
+            sem = self._dense_search(g, self._query_embeddings(queries), n, mask, n_rows)
+
+        lex = None
+        if g.bm25 is not None:
+            qtoks = [[i for i in map(g.vocab.get, _tokenize(q)) if i is not None] for q in queries]
+            lex = g.bm25.top_n_batch(qtoks, n, mask)
+
+        top = max(k, self.rerank_topn) if self.use_rerank else k
+        empty = np.zeros(0, dtype=np.int64)
+        hit_lists = []
+        for qi in range(len(queries)):
+            sem_ids, sem_scores = empty, empty
+            if sem is not None:
+                found = sem[1][qi] >= 0
+                sem_ids, sem_scores = sem[1][qi][found], sem[0][qi][found]
+            lex_ids, lex_scores = lex[qi] if lex is not None else (empty, empty)
+
+            cand, score, s_sem, s_lex = _fuse(sem_ids, sem_scores, lex_ids, lex_scores,
+                self.hybrid_alpha, top, self.fusion, self.rrf_k)
+            hit_lists.append([self._hit(g.chunks[int(i)], score[j], s_sem[j], s_lex[j]) for j, i in enumerate(cand)])
+
+        hit_lists, complete = self._rerank_batch(g, queries, hit_lists)
+        return [hits[:k] for hits in hit_lists], complete
+
+    def _hit(self, c, score, s_sem, s_lex):
+        return {
+            "source": c.source,
+            "doc_id": c.doc_id,
+            "chunk_id": c.chunk_id,
+            "title": c.title,
+            "text": c.text,
+            "score": float(score),
+            "score_sem": float(s_sem),
+            "score_lex": float(s_lex),
+            **_provenance(c),
+        }
+
+    def _rerank_batch(self, g, queries, hit_lists):
+        if not self.use_rerank:
+            return hit_lists, [True] * len(hit_lists)
+        return self._rerank_stage.rerank(queries, hit_lists, g.build_id)
+
+    def batcher_stats(self):
+        if self._query_batcher is None:
+            return None
+        return self._query_batcher.snapshot()
+
+    def rerank_stats(self):
+        if not self.use_rerank:
+            return None
+        return self._rerank_stage.snapshot()
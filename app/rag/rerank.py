@@ -0,0 +1,95 @@
+import threading
+import time
+
+from .cache import LRUCache, normalize_query, query_hash
+
+class RerankStage:
+    def __init__(self, load_model, topn, batch_size=32, budget_ms=0, skip_margin=0.0, cache_size=20000):
+        self.load_model = load_model
+        self.topn = topn
+        self.batch_size = max(1, batch_size)
+        self.budget_ms = budget_ms
+        self.skip_margin = skip_margin
+        self._cache = LRUCache(cache_size)
+        self._generation = None
+        self._batch_ms = None
+        self._lock = threading.Lock()
+        self.stats = {"pairs_scored": 0, "cache_hits": 0, "skipped": 0, "truncated": 0, "failed": 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def _depth(self, hits):
+        n = min(max(1, self.topn), len(hits))
+        if self.skip_margin > 0 and n > 1 and hits[0]["score"] - hits[1]["score"] >= self.skip_margin:
+            self._count("skipped")
+            return 0
+        return n
+
+    def _over_budget(self, started):
+        if self.budget_ms <= 0 or self._batch_ms is None:
+            return False
+        elapsed = (time.perf_counter() - started) * 1000
+        return elapsed + self._batch_ms > self.budget_ms
+
+    def rerank(self, queries, hit_lists, generation=None):
+        if generation != self._generation:
+            self._cache.clear()
+            self._generation = generation
+
+        depths = [self._depth(hits) for hits in hit_lists]
+        qkeys = [query_hash(normalize_query(q)) for q in queries]
+        scores = [{} for _ in hit_lists]
+        pending = []
+        for qi, hits in enumerate(hit_lists):
+            for j in range(depths[qi]):
+                sc = self._cache.get((qkeys[qi], hits[j]["chunk_id"]))
+                if sc is None:
+                    pending.append((j, qi))
+                else:
+                    scores[qi][j] = sc
+                    self._count("cache_hits")
+        pending.sort()
+
+        started = time.perf_counter()
+        done = 0
+        try:
+            while done < len(pending):
+                if done and self._over_budget(started):
+                    self._count("truncated")
+                    break
+                batch = pending[done:done + self.batch_size]
+                t0 = time.perf_counter()
+                pairs = [[queries[qi], hit_lists[qi][j]["text"]] for j, qi in batch]
+                out = self.load_model().predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+                ms = (time.perf_counter() - t0) * 1000
+                self._batch_ms = ms if self._batch_ms is None else 0.8 * self._batch_ms + 0.2 * ms
+                for (j, qi), sc in zip(batch, out):
+                    scores[qi][j] = float(sc)
+                    self._cache.put((qkeys[qi], hit_lists[qi][j]["chunk_id"]), float(sc))
+                done += len(batch)
+                self._count("pairs_scored", len(batch))
+        except Exception:
+            self._count("failed")
+
+        # a query whose depth was not fully scored (budget cut or model error) is reported incomplete
+        result = []
+        complete = []
+        for qi, hits in enumerate(hit_lists):
+            m = 0
+            while m < depths[qi] and m in scores[qi]:
+                m += 1
+            complete.append(m == depths[qi])
+            subset = hits[:m]
+            for j, h in enumerate(subset):
+                h["rerank_score"] = scores[qi][j]
+            subset.sort(key=lambda x: x["rerank_score"], reverse=True)
+            result.append(subset + hits[m:])
+        return result, complete
+
+    def snapshot(self):
+        with self._lock:
+            out = dict(self.stats)
+        out["batch_ms"] = self._batch_ms
+        return out
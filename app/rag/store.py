@@ -1,11 +1,309 @@
 import json
+import os
+import shutil
+import struct
+from collections.abc import Sequence
+from contextlib import contextmanager
 from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
 import faiss
 
-def save_chunks(index_dir: Path, chunks):
-    (index_dir / "chunks.json").write_text(
-        json.dumps(chunks, ensure_ascii=False, indent=2),
-        encoding="utf-8")
+INDEX_FILE = "kb.idx"
+CURRENT_FILE = "CURRENT"
+GENERATION_PREFIX = "gen-"
+INDEX_MAGIC = b"KBIDX\0\0\0"
+INDEX_VERSION = 1
+CHUNK_FIELDS = ("doc_id", "source", "chunk_id", "title", "text", "page", "row_start", "row_end")
+_DICT_FIELDS = {"doc_id", "source"}
+_INT_FIELDS = {"page", "row_start", "row_end"}
+_ALIGN = 64
+_WRITE_CHUNK = 64 << 20
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+def _encode_strings(values):
+    data = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in data], out=offsets[1:])
+    return np.frombuffer(b"".join(data), dtype=np.uint8), offsets
+
+def _write_index_file(path: Path, meta, arrays):
+    layout = {}
+    end = 0
+    for name, a in arrays.items():
+        layout[name] = [a.dtype.str, int(a.shape[0]), end]
+        end += _aligned(a.nbytes)
+    header = json.dumps({"version": INDEX_VERSION, **meta, "arrays": layout}).encode("utf-8")
+    data_start = _aligned(16 + len(header))
+
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack("<II", INDEX_VERSION, len(header)))
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(data_start + layout[name][2])
+            step = max(1, _WRITE_CHUNK // max(1, a.itemsize))
+            for i in range(0, len(a), step):
+                f.write(np.ascontiguousarray(a[i:i + step]).tobytes())
+        f.truncate(data_start + end)
+    os.replace(tmp, path)
+
+class _ArrayFile:
+    def __init__(self, path: Path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+        self._f = path.open("wb")
+
+    def append(self, values):
+        a = np.ascontiguousarray(values, dtype=self.dtype)
+        self._f.write(a.tobytes())
+        self.n += len(a)
+
+    def array(self):
+        self.close()
+        if not self.n:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode="r", shape=(self.n,))
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+
+class _RaggedFile:
+    def __init__(self, path: Path, name, dtype):
+        self.values = _ArrayFile(path / f"{name}.values", dtype)
+        self.offsets = _ArrayFile(path / f"{name}.offsets", np.int64)
+        self.offsets.append([0])
+        self._end = 0
+
+    def append(self, parts):
+        parts = [np.asarray(p, dtype=self.values.dtype) for p in parts]
+        lens = np.fromiter((len(p) for p in parts), dtype=np.int64, count=len(parts))
+        self.offsets.append(self._end + np.cumsum(lens))
+        self._end += int(lens.sum())
+        if parts:
+            self.values.append(np.concatenate(parts))
+
+    def append_strings(self, values):
+        self.append([np.frombuffer(v.encode("utf-8"), dtype=np.uint8) for v in values])
+
+    def arrays(self):
+        return self.values.array(), self.offsets.array()
+
+    def close(self):
+        self.values.close()
+        self.offsets.close()
+
+class ChunkSpool:
+    # chunk columns and token ids are appended batch by batch to files under `path`,
+    # so building kb.idx never needs the whole corpus in memory
+    def __init__(self, path: Path):
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        self.path = path
+        self.n_chunks = 0
+        self.tables = {name: {} for name in CHUNK_FIELDS if name in _DICT_FIELDS}
+        self._files = {}
+        for name in CHUNK_FIELDS:
+            if name in _INT_FIELDS:
+                self._files[name] = _ArrayFile(path / f"{name}.values", np.int64)
+            elif name in _DICT_FIELDS:
+                self._files[name] = _ArrayFile(path / f"{name}.codes", np.int32)
+            else:
+                self._files[name] = _RaggedFile(path, name, np.uint8)
+        self._tokens = _RaggedFile(path, "tokens", np.int32)
+
+    def append(self, chunks, token_ids):
+        for name in CHUNK_FIELDS:
+            values = [getattr(c, name) for c in chunks]
+            if name in _INT_FIELDS:
+                self._files[name].append([-1 if v is None else v for v in values])
+            elif name in _DICT_FIELDS:
+                table = self.tables[name]
+                self._files[name].append([table.setdefault(v, len(table)) for v in values])
+            else:
+                self._files[name].append_strings(values)
+        self._tokens.append(token_ids)
+        self.n_chunks += len(chunks)
+
+    def doc_count(self):
+        return len(self.tables["doc_id"])
+
+    def tokens(self):
+        return self._tokens.arrays()
+
+    def texts(self):
+        blob, offsets = self._files["text"].arrays()
+        for i in range(self.n_chunks):
+            yield bytes(blob[int(offsets[i]):int(offsets[i + 1])]).decode("utf-8")
+
+    def arrays(self):
+        arrays = {}
+        columns = {}
+        for name in CHUNK_FIELDS:
+            f = self._files[name]
+            if name in _INT_FIELDS:
+                arrays[f"{name}.values"] = f.array()
+                columns[name] = "int"
+            elif name in _DICT_FIELDS:
+                arrays[f"{name}.codes"] = f.array()
+                arrays[f"{name}.blob"], arrays[f"{name}.offsets"] = _encode_strings(list(self.tables[name]))
+                columns[name] = "dict"
+            else:
+                arrays[f"{name}.blob"], arrays[f"{name}.offsets"] = f.arrays()
+                columns[name] = "str"
+        arrays["tokens.ids"], arrays["tokens.offsets"] = self._tokens.arrays()
+        return arrays, columns
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._tokens.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def save_index(index_dir: Path, spool: ChunkSpool, vocab, extra_arrays=None):
+    arrays, columns = spool.arrays()
+    arrays["vocab.blob"], arrays["vocab.offsets"] = _encode_strings(vocab)
+    enc = [t.encode("utf-8") for t in vocab]
+    arrays["vocab.order"] = np.array(sorted(range(len(enc)), key=enc.__getitem__), dtype=np.int32)
+    arrays.update(extra_arrays or {})
+
+    _write_index_file(index_dir / INDEX_FILE, {"n_chunks": spool.n_chunks, "columns": columns}, arrays)
+
+class IndexFile:
+    def __init__(self, path: Path):
+        with path.open("rb") as f:
+            head = f.read(16)
+            if len(head) < 16 or head[:8] != INDEX_MAGIC:
+                raise ValueError(f"Not a KB index file: {path}")
+            version, header_len = struct.unpack("<II", head[8:])
+            if version != INDEX_VERSION:
+                raise ValueError(f"Unsupported KB index version {version} in {path}")
+            self.meta = json.loads(f.read(header_len).decode("utf-8"))
+
+        self.path = path
+        self.n_chunks = int(self.meta["n_chunks"])
+        self.columns = self.meta["columns"]
+        data_start = _aligned(16 + header_len)
+        mm = np.memmap(path, dtype=np.uint8, mode="r")
+        self._arrays = {}
+        for name, (dt, n, off) in self.meta["arrays"].items():
+            dt = np.dtype(dt)
+            start = data_start + off
+            self._arrays[name] = mm[start:start + n * dt.itemsize].view(dt)
+        self._tables = {}
+
+    def has(self, name):
+        return name in self._arrays
+
+    def array(self, name):
+        return self._arrays[name]
+
+    def _string(self, col, i):
+        offsets = self._arrays[f"{col}.offsets"]
+        a, b = int(offsets[i]), int(offsets[i + 1])
+        return bytes(self._arrays[f"{col}.blob"][a:b]).decode("utf-8")
+
+    def strings(self, col):
+        n = len(self._arrays[f"{col}.offsets"]) - 1
+        return [self._string(col, i) for i in range(n)]
+
+    def dict_values(self, name):
+        if name not in self._tables:
+            self._tables[name] = self.strings(name)
+        return self._tables[name]
+
+    def codes(self, name):
+        return self._arrays[f"{name}.codes"]
+
+    def field(self, name, i):
+        kind = self.columns[name]
+        if kind == "int":
+            v = int(self._arrays[f"{name}.values"][i])
+            return None if v < 0 else v
+        if kind == "dict":
+            return self._string(name, int(self.codes(name)[i]))
+        return self._string(name, i)
+
+    def row(self, i):
+        return {name: self.field(name, i) for name in self.columns}
+
+    def tokens(self, i):
+        offsets = self._arrays["tokens.offsets"]
+        return self._arrays["tokens.ids"][int(offsets[i]):int(offsets[i + 1])]
+
+    def vocab(self):
+        return self.strings("vocab")
+
+class VocabLookup:
+    def __init__(self, index_file: IndexFile):
+        self.index_file = index_file
+        self.order = index_file.array("vocab.order")
+
+    def _term(self, i):
+        ix = self.index_file
+        offsets = ix.array("vocab.offsets")
+        return bytes(ix.array("vocab.blob")[int(offsets[i]):int(offsets[i + 1])])
+
+    def get(self, term, default=None):
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self._term(self.order[lo]) == key:
+            return int(self.order[lo])
+        return default
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __len__(self):
+        return len(self.order)
+
+    def items(self):
+        return ((t, i) for i, t in enumerate(self.index_file.vocab()))
+
+class ChunkTable(Sequence):
+    def __init__(self, index_file: IndexFile, factory):
+        self.index_file = index_file
+        self.factory = factory
+
+    def __len__(self):
+        return self.index_file.n_chunks
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.factory(**self.index_file.row(i))
+
+    def doc_mask(self, doc_ids):
+        values = self.index_file.dict_values("doc_id")
+        sel = [j for j, v in enumerate(values) if v in doc_ids]
+        return np.isin(self.index_file.codes("doc_id"), sel)
+
+    def doc_count(self):
+        return len(np.unique(self.index_file.codes("doc_id")))
+
+def load_index(index_dir: Path):
+    p = index_dir / INDEX_FILE
+    if not p.exists():
+        return None
+    return IndexFile(p)
 
 def load_chunks(index_dir: Path):
     p = index_dir / "chunks.json"
@@ -13,22 +311,86 @@ def load_chunks(index_dir: Path):
         return None
     return json.loads(p.read_text(encoding="utf-8"))
 
-def save_bm25_tokens(index_dir: Path, tokens):
-    (index_dir / "bm25_tokens.json").write_text(
-        json.dumps(tokens, ensure_ascii=False),
-        encoding="utf-8")
-
 def load_bm25_tokens(index_dir: Path):
     p = index_dir / "bm25_tokens.json"
     if not p.exists():
         return None
     return json.loads(p.read_text(encoding="utf-8"))
 
+def remove_legacy_json(index_dir: Path):
+    (index_dir / "chunks.json").unlink(missing_ok=True)
+    (index_dir / "bm25_tokens.json").unlink(missing_ok=True)
+
 def save_faiss(index_dir: Path, faiss_index):
-    faiss.write_index(faiss_index, str(index_dir / "faiss.index"))
+    p = index_dir / "faiss.index"
+    tmp = p.with_name(p.name + ".tmp")
+    faiss.write_index(faiss_index, str(tmp))
+    os.replace(tmp, p)
 
-def load_faiss(index_dir: Path):
+def load_faiss(index_dir: Path, io_flags=0):
     p = index_dir / "faiss.index"
     if not p.exists():
         return None
+    if io_flags:
+        try:
+            return faiss.read_index(str(p), io_flags)
+        except RuntimeError:
+            pass
     return faiss.read_index(str(p))
+
+def save_manifest(index_dir: Path, manifest):
+    p = index_dir / "manifest.json"
+    tmp = p.with_name(p.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, p)
+
+def load_manifest(index_dir: Path):
+    p = index_dir / "manifest.json"
+    if not p.exists():
+        return None
+    return json.loads(p.read_text(encoding="utf-8"))
+
+def current_dir(index_dir: Path):
+    p = index_dir / CURRENT_FILE
+    if p.exists():
+        name = p.read_text(encoding="utf-8").strip()
+        if name and (index_dir / name).is_dir():
+            return index_dir / name
+    return index_dir
+
+def generation_marker(index_dir: Path):
+    try:
+        st = (index_dir / CURRENT_FILE).stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def new_generation_dir(index_dir: Path, generation, build_id):
+    d = index_dir / f"{GENERATION_PREFIX}{generation:06d}-{build_id[:8]}"
+    shutil.rmtree(d, ignore_errors=True)
+    d.mkdir(parents=True)
+    return d
+
+def publish_generation(index_dir: Path, gen_dir: Path):
+    p = index_dir / CURRENT_FILE
+    tmp = p.with_name(p.name + ".tmp")
+    tmp.write_text(gen_dir.name, encoding="utf-8")
+    os.replace(tmp, p)
+    for name in (INDEX_FILE, "faiss.index", "manifest.json"):
+        (index_dir / name).unlink(missing_ok=True)
+
+def prune_generations(index_dir: Path, keep):
+    for d in index_dir.glob(f"{GENERATION_PREFIX}*"):
+        if d.is_dir() and d.name not in keep:
+            shutil.rmtree(d, ignore_errors=True)
+
+@contextmanager
+def build_lock(index_dir: Path):
+    with (index_dir / ".build.lock").open("a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
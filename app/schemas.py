@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from pydantic import BaseModel, Field
 
 class AskRequest(BaseModel):
@@ -23,8 +25,52 @@ class ReindexResponse(BaseModel):
     ok: bool
     docs: int
     chunks: int
+    incremental: bool = False
+    docs_changed: int = 0
+    docs_removed: int = 0
+    docs_failed: int = 0
+    emb_cache_hits: int = 0
+    emb_cache_misses: int = 0
+    ann_index: str = ""
+    ann_recall: float | None = None
+    ann_storage: str = ""
+    index_bytes: int | None = None
+    rescore_bytes: int | None = None
+    vector_bytes: int | None = None
+    float32_bytes: int | None = None
+
+class ReindexJobResponse(BaseModel):
+    job_id: str
+    collection: str = "default"
+    status: str
+    incremental: bool = False
+    coalesced: int = 0
+    stage: str = ""
+    done: int = 0
+    total: int | None = None
+    created_at: float
+    started_at: float | None = None
+    finished_at: float | None = None
+    result: ReindexResponse | None = None
+    error: str | None = None
+
+class KBSearchFilter(BaseModel):
+    source: list[str] | None = None
+    doc_id_prefix: list[str] | None = None
+    file_type: list[str] | None = None
+    uploaded_after: datetime | None = None
+    uploaded_before: datetime | None = None
+
+class KBSearchBatchRequest(BaseModel):
+    queries: list[str] = Field(..., min_length=1, max_length=256)
+    k: int = Field(5, ge=1, le=50)
+    filters: KBSearchFilter | None = None
+    collection: str | None = None
+
+class KBSearchBatchResponse(BaseModel):
+    results: list[list[dict]]
 
 class UploadResponse(BaseModel):
     ok: bool
     saved: list[dict]
-    reindex: ReindexResponse
+    job: ReindexJobResponse
@@ -1,38 +1,116 @@
+import asyncio
 import re
 from langchain_core.tools import Tool
 
-def build_kb_tools(rag):
+from app.rag.collection import DEFAULT_COLLECTION, UnknownCollection
+from app.rag.filters import SearchFilter
+from app.rag.pool import RetrievalBusy
+
+_FILTER_KEYS = {"source": "source", "prefix": "doc_id_prefix", "type": "file_type",
+    "after": "uploaded_after", "before": "uploaded_before"}
+_collection_re = re.compile(r"\bcollection\s*=\s*([^;]*);\s*")
+_filter_re = re.compile(r"\b(source|prefix|type|after|before)\s*=\s*([^;]*);\s*")
+
+def _format_hits(hits):
+    out = []
+    for h in hits:
+        src = (h.get("source") or "").replace("\\", "/").split("/")[-1]
+        hit = {"source": src, "text": h.get("text", ""), "score": float(h.get("score", 0.0)),}
+        for key in ("page", "rows"):
+            if key in h:
+                hit[key] = h[key]
+        out.append(hit)
+    return out
+
+def _split_queries(query):
+    return [q.strip() for q in (query or "").split("||") if q.strip()]
+
+def _parse_query_k(query_and_k):
+    q = query_and_k or ""
+    m = re.search(r"\bk\s*=\s*(\d+)", q)
+    k = int(m.group(1)) if m else 5
+    q2 = re.sub(r"\bk\s*=\s*\d+\s*;?\s*", "", q).strip()
+    if not q2:
+        q2 = q.strip()
+    return q2, k
+
+def _parse_filters(query):
+    q = query or ""
+    found = {_FILTER_KEYS[m.group(1)]: m.group(2).strip() for m in _filter_re.finditer(q)}
+    if not found:
+        return q, None
+    return _filter_re.sub("", q).strip(), SearchFilter.build(**found)
+
+def _parse_collection(query):
+    q = query or ""
+    m = _collection_re.search(q)
+    if not m:
+        return q, None
+    return _collection_re.sub("", q).strip(), m.group(1).strip()
+
+def build_kb_tools(rag, pool=None, collections=None):
     def _kb_search(query, k=5):
-        hits = rag.search(query, k=int(k))
-        out = []
-        for h in hits:
-            src = (h.get("source") or "").replace("\\", "/").split("/")[-1]
-            out.append({"source": src, "text": h.get("text", ""), "score": float(h.get("score", 0.0)),})
-        return {"hits": out}
+        query, name = _parse_collection(query)
+        target = rag
+        if name and collections is not None:
+            try:
+                target = collections.get(name)
+            except (ValueError, UnknownCollection):
+                return {"hits": [], "error": f"Unknown KB collection: {name}"}
+        try:
+            query, filters = _parse_filters(query)
+        except ValueError as e:
+            return {"hits": [], "error": f"Bad KB filter: {e}"}
+        queries = _split_queries(query)
+        if len(queries) > 1:
+            results = target.search_batch(queries, k=int(k), filters=filters)
+            return {"results": [{"query": q, "hits": _format_hits(h)} for q, h in zip(queries, results)]}
+        hits = target.search(query, k=int(k), filters=filters)
+        return {"hits": _format_hits(hits)}
+
+    async def _akb_search(query, k=5):
+        if pool is None:
+            return await asyncio.to_thread(_kb_search, query, k)
+        try:
+            return await pool.run(_kb_search, query, k)
+        except RetrievalBusy:
+            return {"hits": [], "error": "KB search is overloaded, try again later"}
+        except asyncio.TimeoutError:
+            return {"hits": [], "error": "KB search timed out"}
 
-    def _kb_reindex():
-        rag.reindex()
-        return {"ok": True}
+    def _kb_reindex(arg=None):
+        text, name = _parse_collection(arg)
+        if collections is None:
+            rag.reindex()
+            return {"ok": True}
+        try:
+            jobs = collections.jobs(name)
+        except (ValueError, UnknownCollection):
+            return {"ok": False, "error": f"Unknown KB collection: {name or DEFAULT_COLLECTION}"}
+        job = jobs.submit(incremental="full" not in (text or "").lower())
+        return {"ok": True, "job_id": job["job_id"], "collection": job["collection"], "status": job["status"],
+            "incremental": job["incremental"], "coalesced": job["coalesced"]}
 
     kb_search_tool = Tool(name="kb_search",
-        description="Search in local KB. Input: query string. Returns JSON with hits (source,text,score).",
-        func=lambda query: _kb_search(query, 5))
-
-    def kb_search_k(query_and_k):
-        q = query_and_k or ""
-        m = re.search(r"\bk\s*=\s*(\d+)", q)
-        k = int(m.group(1)) if m else 5
-        q2 = re.sub(r"\bk\s*=\s*\d+\s*;?\s*", "", q).strip()
-        if not q2:
-            q2 = q.strip()
-        return _kb_search(q2, k)
+        description="Search in local KB. Input: query string, or several queries separated by ' || ' "
+            "to search them in one batch. Optional filters before the query, each ending with ';': "
+            "'source=a.pdf,b.md;' 'prefix=<path prefix>;' 'type=pdf,csv;' 'after=YYYY-MM-DD;' 'before=YYYY-MM-DD;' "
+            "(upload date), 'collection=<name>;' to search a named knowledge base. Returns JSON with hits (source,text,score[,page|rows]), "
+            "or results (query,hits) for several queries.",
+        func=lambda query: _kb_search(query, 5),
+        coroutine=lambda query: _akb_search(query, 5))
 
     kb_search_k_tool = Tool(name="kb_search_k",
-        description="Search in local KB with custom k. Input: 'k=7; <your query>'. Returns JSON hits.",
-        func=kb_search_k)
+        description="Search in local KB with custom k. Input: 'k=7; <your query>', "
+            "filters as in kb_search may follow k. Returns JSON hits.",
+        func=lambda query_and_k: _kb_search(*_parse_query_k(query_and_k)),
+        coroutine=lambda query_and_k: _akb_search(*_parse_query_k(query_and_k)))
 
     kb_reindex_tool = Tool(name="kb_reindex",
-        description="Reindex KB from local documents.",
-        func=lambda _=None: _kb_reindex())
+        description="Start a background reindex of the KB from local documents (only changed files). "
+            "Input: empty, or 'full' to rebuild everything; 'collection=<name>;' for a named knowledge base. "
+            "Returns JSON with job_id and status; the reindex continues after the answer.",
+        func=_kb_reindex,
+        coroutine=lambda arg=None: asyncio.to_thread(_kb_reindex, arg))
 
     return [kb_search_tool, kb_search_k_tool, kb_reindex_tool]
@@ -0,0 +1,317 @@
+import argparse
+import json
+import multiprocessing as mp
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from app.config import BASE_DIR, settings
+from app.rag.ann import AnnParams, is_exact_flat, rescore
+from app.rag.rag import HybridRAG
+
+from .synthetic import Corpus, HashEmbedder, OverlapCrossEncoder
+
+FAKE = "fake"
+
+# metric path -> direction; latency/size may grow, throughput/quality may drop
+METRICS = {
+    ("reindex", "chunks_per_s"): "higher",
+    ("load", "load_ms"): "lower",
+    ("load", "rss_delta_mb"): "lower",
+    ("search", "no_rerank", "p50_ms"): "lower",
+    ("search", "no_rerank", "p95_ms"): "lower",
+    ("search", "no_rerank", "p99_ms"): "lower",
+    ("search", "rerank", "p50_ms"): "lower",
+    ("search", "rerank", "p95_ms"): "lower",
+    ("search", "rerank", "p99_ms"): "lower",
+    ("quality", "dense_recall"): "recall",
+    ("quality", "hit_no_rerank"): "recall",
+    ("quality", "hit_rerank"): "recall",
+}
+
+def _size(s):
+    s = s.strip().lower()
+    mult = {"k": 1000, "m": 1000000}.get(s[-1:], 1)
+    return int(float(s.rstrip("km")) * mult)
+
+def _rss_mb():
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def _pct(ms):
+    a = np.asarray(ms, dtype=np.float64)
+    return {"n": len(a), "mean_ms": float(a.mean()), "p50_ms": float(np.percentile(a, 50)),
+        "p95_ms": float(np.percentile(a, 95)), "p99_ms": float(np.percentile(a, 99)),
+        "max_ms": float(a.max())}
+
+class BenchRAG(HybridRAG):
+    def __init__(self, *args, fake_embedder=False, fake_reranker=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fakes = {}
+        if fake_embedder:
+            self._fakes["embedder"] = HashEmbedder()
+        if fake_reranker:
+            self._fakes["reranker"] = OverlapCrossEncoder()
+
+    def _load_model(self, kind, name):
+        fake = self._fakes.get(kind)
+        if fake is None:
+            return super()._load_model(kind, name)
+        self._model_info[kind] = {"backend": FAKE}
+        return fake
+
+def build_rag(kb_dir, index_dir, cfg):
+    return BenchRAG(kb_dir=kb_dir,
+        index_dir=index_dir,
+        emb_model="fake-hash-256" if cfg["embedder"] == FAKE else cfg["embedder"],
+        model_backend=settings.kb_model_backend,
+        onnx_quant_config=settings.kb_onnx_quant_config,
+        onnx_min_parity=settings.kb_onnx_min_parity,
+        emb_cache=False,
+        chunk_max_chars=settings.kb_chunk_max_chars,
+        chunk_overlap_chars=settings.kb_chunk_overlap_chars,
+        ingest_workers=settings.kb_ingest_workers,
+        embed_batch_size=settings.kb_embed_batch_size,
+        hybrid_alpha=settings.kb_hybrid_alpha,
+        candidates=cfg["candidates"],
+        fusion=settings.kb_fusion,
+        rrf_k=settings.kb_rrf_k,
+        use_rerank=False,
+        rerank_model="fake-overlap" if cfg["reranker"] == FAKE else cfg["reranker"],
+        rerank_topn=cfg["rerank_topn"],
+        rerank_batch_size=settings.kb_rerank_batch_size,
+        rerank_budget_ms=settings.kb_rerank_budget_ms,
+        rerank_skip_margin=settings.kb_rerank_skip_margin,
+        rerank_cache_size=settings.kb_rerank_cache_size,
+        ann=AnnParams(kind=cfg["ann_index"],
+            hnsw_min_chunks=settings.kb_ann_hnsw_min_chunks,
+            ivf_min_chunks=settings.kb_ann_ivf_min_chunks,
+            hnsw_m=settings.kb_ann_hnsw_m,
+            ef_construction=settings.kb_ann_ef_construction,
+            ef_search=settings.kb_ann_ef_search,
+            nprobe=settings.kb_ann_nprobe,
+            pq_m=settings.kb_ann_pq_m,
+            min_recall=settings.kb_ann_min_recall,
+            mmap=settings.kb_faiss_mmap,
+            storage=cfg["storage"],
+            rescore=settings.kb_vector_rescore),
+        fake_embedder=cfg["embedder"] == FAKE,
+        fake_reranker=cfg["reranker"] == FAKE)
+
+def _cold_load(kb_dir, index_dir, cfg, probe, out):
+    rag = build_rag(kb_dir, index_dir, cfg)
+    rss0 = _rss_mb()
+    t0 = time.perf_counter()
+    rag.load_if_exists()
+    load_ms = (time.perf_counter() - t0) * 1000
+    rss1 = _rss_mb()
+    rag.warm_up()
+    t0 = time.perf_counter()
+    rag.search(probe, 5)
+    first_ms = (time.perf_counter() - t0) * 1000
+    out.put({"load_ms": load_ms, "rss_before_mb": rss0, "rss_after_mb": rss1,
+        "rss_delta_mb": rss1 - rss0, "first_search_ms": first_ms, "rss_after_search_mb": _rss_mb()})
+
+def cold_load(kb_dir, index_dir, cfg, probe):
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    p = ctx.Process(target=_cold_load, args=(kb_dir, index_dir, cfg, probe, out))
+    p.start()
+    res = out.get()
+    p.join()
+    return res
+
+def _latency(rag, queries, k, warmup=5):
+    for q in queries[:warmup]:
+        rag.search(q["query"], k)
+    ms, results = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        hits = rag.search(q["query"], k)
+        ms.append((time.perf_counter() - t0) * 1000)
+        results.append(hits)
+    return _pct(ms), results
+
+def _hit_rate(queries, results):
+    found = sum(any(h["source"] == q["source"] and h["title"] == q["title"] for h in hits)
+        for q, hits in zip(queries, results))
+    return found / max(1, len(queries))
+
+def _exact_topk(rag, g, qemb, k, block=65536):
+    n = len(g.chunks)
+    best_s = np.full((len(qemb), 0), -np.inf, dtype=np.float32)
+    best_i = np.zeros((len(qemb), 0), dtype=np.int64)
+    for start in range(0, n, block):
+        stop = min(n, start + block)
+        if g.vectors is not None:
+            vecs = np.asarray(g.vectors[start:stop])
+        else:
+            vecs = rag._encode([g.chunks[i].text for i in range(start, stop)])
+        s = np.concatenate([best_s, qemb @ vecs.T], axis=1)
+        i = np.concatenate([best_i, np.broadcast_to(np.arange(start, stop), (len(qemb), stop - start))], axis=1)
+        top = np.argsort(-s, axis=1)[:, :k]
+        best_s, best_i = np.take_along_axis(s, top, 1), np.take_along_axis(i, top, 1)
+    return best_i
+
+def dense_recall(rag, queries, k):
+    g = rag._gen
+    if g.faiss is None:
+        return None
+    if is_exact_flat(g.faiss):
+        return 1.0
+    qemb = rag._encode([q["query"] for q in queries])
+    k = min(k, len(g.chunks))
+    factor = (g.manifest.get("ann") or {}).get("rescore", 1) if g.vectors is not None else 1
+    _, approx = g.faiss.search(qemb, k * factor)
+    if factor > 1:
+        _, approx = rescore(g.vectors, qemb, approx, k)
+    exact = _exact_topk(rag, g, qemb, k)
+    found = sum(len(set(a) & set(e)) for a, e in zip(approx[:, :k].tolist(), exact.tolist()))
+    return found / (len(queries) * k)
+
+def run_size(n_chunks, cfg, work_dir: Path, log):
+    corpus = Corpus(work_dir / f"corpus-{n_chunks}-s{cfg['seed']}", n_chunks, seed=cfg["seed"])
+    t0 = time.perf_counter()
+    fresh = corpus.generate()
+    log(f"[{n_chunks}] corpus {'generated' if fresh else 'reused'} in {time.perf_counter() - t0:.1f}s")
+    kb_dir = corpus.kb_dir
+    index_dir = work_dir / f"index-{n_chunks}"
+    shutil.rmtree(index_dir, ignore_errors=True)
+    index_dir.mkdir(parents=True)
+
+    rag = build_rag(kb_dir, index_dir, cfg)
+    rag.warm_up()
+    t0 = time.perf_counter()
+    out = rag.reindex()
+    reindex_s = time.perf_counter() - t0
+    reindex = {"seconds": reindex_s, "chunks": out["chunks"], "docs": out["docs"],
+        "chunks_per_s": out["chunks"] / reindex_s, "ann_index": out["ann_index"],
+        "ann_storage": out["ann_storage"], "ann_recall": out["ann_recall"],
+        "index_bytes": out["index_bytes"], "rescore_bytes": out["rescore_bytes"],
+        "vector_bytes": out["vector_bytes"], "disk_bytes": sum(f.stat().st_size for f in index_dir.rglob("*") if f.is_file())}
+    log(f"[{n_chunks}] reindex {reindex_s:.1f}s ({reindex['chunks_per_s']:.0f} chunks/s, {out['ann_index']})")
+
+    queries = corpus.queries(cfg["queries"], seed=cfg["seed"] + 1)
+    load = cold_load(kb_dir, index_dir, cfg, queries[0]["query"])
+    log(f"[{n_chunks}] cold load {load['load_ms']:.0f}ms, +{load['rss_delta_mb']:.0f}MB RSS")
+
+    rag.use_rerank = False
+    lat_plain, res_plain = _latency(rag, queries, cfg["k"])
+    rag.use_rerank = True
+    lat_rerank, res_rerank = _latency(rag, queries, cfg["k"])
+    rag.use_rerank = False
+    log(f"[{n_chunks}] search p95 {lat_plain['p95_ms']:.1f}ms, with rerank {lat_rerank['p95_ms']:.1f}ms")
+
+    quality = {"k": cfg["k"],
+        "dense_recall": dense_recall(rag, queries[:cfg["recall_queries"]], cfg["k"]),
+        "hit_no_rerank": _hit_rate(queries, res_plain),
+        "hit_rerank": _hit_rate(queries, res_rerank)}
+    log(f"[{n_chunks}] dense recall@{cfg['k']} {quality['dense_recall']}, hit@{cfg['k']} "
+        f"{quality['hit_no_rerank']:.3f} / {quality['hit_rerank']:.3f}")
+
+    if not cfg["keep_index"]:
+        shutil.rmtree(index_dir, ignore_errors=True)
+    return {"chunks": n_chunks, "reindex": reindex, "load": load,
+        "search": {"no_rerank": lat_plain, "rerank": lat_rerank}, "quality": quality}
+
+def _get(run, path):
+    for key in path:
+        if not isinstance(run, dict):
+            return None
+        run = run.get(key)
+    return run
+
+def compare(baseline, current, max_regression=0.2, max_recall_drop=0.01):
+    base_runs = {r["chunks"]: r for r in baseline.get("runs", [])}
+    problems = []
+    for run in current.get("runs", []):
+        base = base_runs.get(run["chunks"])
+        if base is None:
+            continue
+        for path, direction in METRICS.items():
+            old, new = _get(base, path), _get(run, path)
+            if old is None or new is None:
+                continue
+            name = f"{run['chunks']}:{'.'.join(path)}"
+            if direction == "recall" and new < old - max_recall_drop:
+                problems.append(f"{name} dropped {old:.4f} -> {new:.4f}")
+            elif direction == "lower" and old > 0 and new > old * (1 + max_regression):
+                problems.append(f"{name} grew {old:.2f} -> {new:.2f} (+{(new / old - 1) * 100:.0f}%)")
+            elif direction == "higher" and new < old * (1 - max_regression):
+                problems.append(f"{name} fell {old:.2f} -> {new:.2f} ({(new / old - 1) * 100:.0f}%)")
+    return problems
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+            capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="HybridRAG retrieval benchmark")
+    ap.add_argument("--sizes", default="1k", help="comma separated corpus sizes in chunks, e.g. 1k,100k,1m")
+    ap.add_argument("--queries", type=int, default=500)
+    ap.add_argument("--recall-queries", type=int, default=100)
+    ap.add_argument("-k", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--embedder", default=FAKE, help=f"'{FAKE}' or a sentence-transformers model name")
+    ap.add_argument("--reranker", default=FAKE, help=f"'{FAKE}' or a cross-encoder model name")
+    ap.add_argument("--candidates", type=int, default=settings.kb_candidates)
+    ap.add_argument("--rerank-topn", type=int, default=settings.kb_rerank_topn)
+    ap.add_argument("--ann-index", default=settings.kb_ann_index)
+    ap.add_argument("--storage", default=settings.kb_vector_storage)
+    ap.add_argument("--work-dir", type=Path, default=Path(tempfile.gettempdir()) / "kb-bench")
+    ap.add_argument("--keep-index", action="store_true")
+    ap.add_argument("--out", type=Path, help="write results JSON here (default: stdout)")
+    ap.add_argument("--baseline", type=Path, help="previous results JSON; exit 1 on regression")
+    ap.add_argument("--current", type=Path, help="compare this results JSON with --baseline instead of running")
+    ap.add_argument("--max-regression", type=float, default=0.2, help="allowed relative latency/throughput change")
+    ap.add_argument("--max-recall-drop", type=float, default=0.01, help="allowed absolute recall/hit@k drop")
+    args = ap.parse_args(argv)
+
+    def log(msg):
+        print(msg, file=sys.stderr, flush=True)
+
+    if args.current is not None:
+        result = json.loads(args.current.read_text(encoding="utf-8"))
+    else:
+        cfg = {"embedder": args.embedder, "reranker": args.reranker, "candidates": args.candidates,
+            "rerank_topn": args.rerank_topn, "ann_index": args.ann_index, "storage": args.storage,
+            "k": args.k, "queries": args.queries, "recall_queries": args.recall_queries,
+            "seed": args.seed, "keep_index": args.keep_index}
+        result = {"meta": {"created_at": time.time(), "git": _git_rev(), "python": platform.python_version(),
+                "platform": platform.platform(), "faiss": faiss.__version__, "config": cfg},
+            "runs": [run_size(_size(s), cfg, args.work_dir, log) for s in args.sizes.split(",") if s.strip()]}
+        text = json.dumps(result, indent=2)
+        if args.out is not None:
+            args.out.write_text(text, encoding="utf-8")
+        else:
+            print(text)
+
+    if args.baseline is None:
+        return 0
+    problems = compare(json.loads(args.baseline.read_text(encoding="utf-8")), result,
+        args.max_regression, args.max_recall_drop)
+    for p in problems:
+        log(f"REGRESSION {p}")
+    if not problems:
+        log("no regressions")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
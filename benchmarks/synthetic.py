@@ -0,0 +1,130 @@
+import json
+import re
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+_SYLLABLES = [c + v for c in "bdfgklmnprstvz" for v in "aeiou"]
+
+def _tokenize(text):
+    return re.findall(r"[a-zA-Zа-яА-Я0-9_]+", text.lower())
+
+def make_vocab(size, seed=0):
+    rng = np.random.default_rng(seed)
+    words = set()
+    while len(words) < size:
+        n = int(rng.integers(2, 5))
+        words.add("".join(_SYLLABLES[i] for i in rng.integers(0, len(_SYLLABLES), n)))
+    return sorted(words)
+
+class Corpus:
+    def __init__(self, kb_dir: Path, n_chunks, seed=0, vocab_size=20000, topics=200,
+            topic_words=80, words_per_chunk=70, chunks_per_doc=50):
+        self.kb_dir = kb_dir
+        self.n_chunks = n_chunks
+        self.seed = seed
+        self.vocab = make_vocab(vocab_size, seed)
+        self.topics = topics
+        self.topic_words = topic_words
+        self.words_per_chunk = words_per_chunk
+        self.chunks_per_doc = chunks_per_doc
+
+    @property
+    def params(self):
+        return {"n_chunks": self.n_chunks, "seed": self.seed, "vocab_size": len(self.vocab),
+            "topics": self.topics, "topic_words": self.topic_words,
+            "words_per_chunk": self.words_per_chunk, "chunks_per_doc": self.chunks_per_doc}
+
+    def _doc_rel(self, d):
+        return f"d{d // 1000:04d}/doc{d:07d}.md"
+
+    def _title(self, d, s):
+        return f"Section {d}-{s}"
+
+    def _chunk_words(self, rng, topic_ids):
+        v = len(self.vocab)
+        n_topic = self.words_per_chunk // 2
+        topical = topic_ids[rng.integers(0, len(topic_ids), n_topic)]
+        background = np.minimum(rng.zipf(1.3, self.words_per_chunk - n_topic) - 1, v - 1)
+        ids = np.concatenate([topical, background])
+        rng.shuffle(ids)
+        return ids
+
+    def _topic_ids(self, topic):
+        rng = np.random.default_rng([self.seed, topic])
+        return rng.choice(len(self.vocab), self.topic_words, replace=False)
+
+    def generate(self):
+        marker = self.kb_dir / ".corpus.json"
+        if marker.exists() and json.loads(marker.read_text(encoding="utf-8")) == self.params:
+            return False
+        if marker.exists():
+            raise RuntimeError(f"{self.kb_dir} holds a different corpus, remove it or use another --work-dir")
+        self.kb_dir.mkdir(parents=True, exist_ok=True)
+
+        topics = [self._topic_ids(t) for t in range(self.topics)]
+        n_docs = -(-self.n_chunks // self.chunks_per_doc)
+        for d in range(n_docs):
+            rng = np.random.default_rng([self.seed, 1, d])
+            n = min(self.chunks_per_doc, self.n_chunks - d * self.chunks_per_doc)
+            parts = []
+            for s in range(n):
+                ids = self._chunk_words(rng, topics[int(rng.integers(0, self.topics))])
+                parts.append(f"# {self._title(d, s)}\n\n" + " ".join(self.vocab[i] for i in ids) + "\n")
+            path = self.kb_dir / self._doc_rel(d)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("\n".join(parts), encoding="utf-8")
+
+        marker.write_text(json.dumps(self.params), encoding="utf-8")
+        return True
+
+    def queries(self, n, words=4, seed=1):
+        rng = np.random.default_rng([self.seed, 2, seed])
+        out = []
+        for c in rng.choice(self.n_chunks, min(n, self.n_chunks), replace=False).tolist():
+            d, s = divmod(c, self.chunks_per_doc)
+            path = self.kb_dir / self._doc_rel(d)
+            section = path.read_text(encoding="utf-8").split("\n# ")[s]
+            body = _tokenize(section.split("\n", 2)[-1])
+            picked = rng.choice(len(body), min(words, len(body)), replace=False)
+            out.append({"query": " ".join(body[i] for i in sorted(picked)),
+                "source": self._doc_rel(d), "title": self._title(d, s)})
+        return out
+
+class HashEmbedder:
+    def __init__(self, dim=256, seed=0):
+        self.dim = dim
+        self.seed = seed
+        self._ids = {}
+        self._table = np.zeros((0, dim), dtype=np.float32)
+
+    def _vector(self, token):
+        rng = np.random.default_rng([self.seed, zlib.crc32(token.encode("utf-8"))])
+        return rng.standard_normal(self.dim).astype(np.float32)
+
+    def _token_ids(self, tokens):
+        fresh = [t for t in dict.fromkeys(tokens) if t not in self._ids]
+        if fresh:
+            base = len(self._ids)
+            self._table = np.concatenate([self._table, np.stack([self._vector(t) for t in fresh])])
+            for i, t in enumerate(fresh):
+                self._ids[t] = base + i
+        return [self._ids[t] for t in tokens]
+
+    def encode(self, texts, normalize_embeddings=True, show_progress_bar=False, batch_size=None, **kwargs):
+        toks = [_tokenize(t) or ["_"] for t in texts]
+        ids = np.asarray(self._token_ids([t for tt in toks for t in tt]), dtype=np.int64)
+        starts = np.cumsum([0] + [len(tt) for tt in toks[:-1]])
+        out = np.add.reduceat(self._table[ids], starts, axis=0) if len(texts) else np.zeros((0, self.dim), np.float32)
+        if normalize_embeddings:
+            out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        return out.astype(np.float32)
+
+class OverlapCrossEncoder:
+    def predict(self, pairs, batch_size=32, show_progress_bar=False, **kwargs):
+        out = np.empty(len(pairs), dtype=np.float32)
+        for i, (q, text) in enumerate(pairs):
+            qt = set(_tokenize(q))
+            out[i] = len(qt & set(_tokenize(text))) / max(1, len(qt))
+        return out
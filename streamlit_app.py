@@ -1,4 +1,6 @@
 import os
+import json
+import time
 import mimetypes
 import requests
 import streamlit as st
@@ -37,8 +39,37 @@ def new_session():
 def ask(session_id, question, k=5):
     return api_post(f"/sessions/{session_id}/ask", {"question": question, "k": k}, timeout=180)
 
+def ask_stream(session_id, question, k=5):
+    with requests.post(f"{API_BASE}/sessions/{session_id}/ask:stream",
+            json={"question": question, "k": k}, stream=True, timeout=180) as r:
+        if not r.ok:
+            raise RuntimeError(f"{r.status_code} {r.reason}\n{r.text}")
+        r.encoding = "utf-8"
+        event, data = "message", []
+        for line in r.iter_lines(decode_unicode=True):
+            if line is None:
+                continue
+            if not line:
+                if data:
+                    yield event, json.loads("\n".join(data))
+                event, data = "message", []
+            elif line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].strip())
+
 def reindex():
-    return api_post("/reindex", timeout=300)
+    return api_post("/reindex", timeout=60)
+
+def wait_reindex(job, status=None, poll_s=1.0):
+    while job["status"] in ("queued", "running"):
+        if status is not None:
+            status.caption(f"Reindex: {job['status']} {job['stage']} {job['done']}/{job['total'] or '?'}")
+        time.sleep(poll_s)
+        job = api_get(f"/reindex/jobs/{job['job_id']}")
+    if job["status"] == "failed":
+        raise RuntimeError(f"Reindex failed: {job['error']}")
+    return job["result"]
 
 def upload_to_kb(uploaded_files):
     files = []
@@ -46,7 +77,7 @@ def upload_to_kb(uploaded_files):
         content = uf.getvalue()
         mime = mimetypes.guess_type(uf.name)[0] or "application/octet-stream"
         files.append(("files", (uf.name, content, mime)))
-    return api_post("/kb/upload", files=files, timeout=300)
+    return api_post("/kb/upload", files=files, timeout=60)
 
 st.sidebar.title("Chatbot")
 
@@ -61,12 +92,13 @@ if st.sidebar.button("Upload & Reindex", disabled=not uploaded):
     with st.spinner("Uploading and reindexing..."):
         out = upload_to_kb(uploaded)
         st.sidebar.success(f"Uploaded {len(out.get('saved', []))} file(s).")
-        st.sidebar.caption(f"Reindex: docs={out['reindex']['docs']} chunks={out['reindex']['chunks']}")
+        res = wait_reindex(out["job"], st.sidebar.empty())
+        st.sidebar.caption(f"Reindex: docs={res['docs']} chunks={res['chunks']}")
 
 if st.sidebar.button("Reindex KB"):
     with st.spinner("Reindexing..."):
-        out = reindex()
-        st.sidebar.success(f"docs={out['docs']} chunks={out['chunks']}")
+        res = wait_reindex(reindex(), st.sidebar.empty())
+        st.sidebar.success(f"docs={res['docs']} chunks={res['chunks']}")
 
 st.sidebar.subheader("Sessions")
 if st.sidebar.button("New chat"):
@@ -140,22 +172,40 @@ if q and st.session_state.get("session_id"):
         st.markdown(q)
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                out = ask(session_id, q, k=5)
-            except Exception as e:
-                st.error(str(e))
-                st.stop()
-
-            ans = (out.get("answer") or "").strip()
-            srcs = out.get("sources") or []
-
-            st.markdown(ans if ans else "_(empty answer)_")
-
-            if srcs:
-                st.markdown("**Sources (KB):**")
-                for s in srcs:
-                    st.caption(f"- {s.get('source')}")
+        status = st.empty()
+        placeholder = st.empty()
+        status.caption("Thinking...")
+        text, out = "", {}
+        try:
+            for event, data in ask_stream(session_id, q, k=5):
+                if event == "route":
+                    status.caption(f"Route: {data['route'].upper()}")
+                elif event == "tool_start":
+                    status.caption(f"Tool: {data['name']}...")
+                    text = ""
+                elif event == "tool_end":
+                    status.caption(f"Tool done: {data['name']}")
+                elif event == "token":
+                    text += data["text"]
+                    placeholder.markdown(text + "▌")
+                elif event == "error":
+                    raise RuntimeError(data["error"])
+                elif event == "done":
+                    out = data
+        except Exception as e:
+            st.error(str(e))
+            st.stop()
+
+        status.empty()
+        ans = (out.get("answer") or text).strip()
+        srcs = out.get("sources") or []
+
+        placeholder.markdown(ans if ans else "_(empty answer)_")
+
+        if srcs:
+            st.markdown("**Sources (KB):**")
+            for s in srcs:
+                st.caption(f"- {s.get('source')}")
 
 
     st.session_state["chat"].append(("assistant", ans))